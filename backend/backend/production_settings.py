@@ -28,6 +28,16 @@ DEBUG = False
 
 PARALLEL_SOLVERS = multiprocessing.cpu_count()
 DEFAULT_BULK_FOLDER = '/home/app/web/staticfiles/bulk'
+VARIANTS_CHECKPOINT_FOLDER = '/home/app/web/checkpoints'
+VARIANTS_SNAPSHOT_FOLDER = '/home/app/web/snapshots'
+VARIANTS_CHECKPOINT_INTERVAL = 60
+VARIANTS_CHECKPOINT_RETENTION_DAYS = 7
+JOB_PROGRESS_INTERVAL = 5
+JOB_MESSAGE_TAIL = 200
+# Limits on the work of a single generator combo, None meaning no limit
+VARIANTS_COMBO_MAX_TRIE_SIZE = None
+VARIANTS_COMBO_MAX_AND_PAIRS = None
+VARIANTS_COMBO_MAX_SECONDS = None
 
 # Security settings
 ALLOWED_HOSTS = [
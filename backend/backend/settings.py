@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -27,6 +28,16 @@ DEBUG = True
 
 PARALLEL_SOLVERS = 20
 DEFAULT_BULK_FOLDER = './temp/bulk'
+VARIANTS_CHECKPOINT_FOLDER = './temp/checkpoints'
+VARIANTS_SNAPSHOT_FOLDER = './temp/snapshots'
+VARIANTS_CHECKPOINT_INTERVAL = 60
+VARIANTS_CHECKPOINT_RETENTION_DAYS = 7
+JOB_PROGRESS_INTERVAL = 5
+JOB_MESSAGE_TAIL = 200
+# Limits on the work of a single generator combo, None meaning no limit
+VARIANTS_COMBO_MAX_TRIE_SIZE = None
+VARIANTS_COMBO_MAX_AND_PAIRS = None
+VARIANTS_COMBO_MAX_SECONDS = None
 
 ALLOWED_HOSTS = ['*']
 CSRF_TRUSTED_ORIGINS = [
@@ -87,7 +98,9 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQL_DATABASE', BASE_DIR / 'db.sqlite3'),
+        # A file, so that the tests can start generation workers in other processes
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -157,8 +157,25 @@ class ComboAdmin(admin.ModelAdmin):
 
 @admin.register(Job)
 class JobAdmin(admin.ModelAdmin):
-    fields = ['id', 'name', 'status', 'created', 'expected_termination', 'termination', 'message', 'started_by']
-    list_display = ['id', 'name', 'status', 'created', 'expected_termination', 'termination']
+    fields = ['id', 'name', 'status', 'created', 'expected_termination', 'termination', 'progress', 'message', 'profile', 'skipped', 'started_by']
+    readonly_fields = ['progress']
+    list_display = ['id', 'name', 'status', 'created', 'expected_termination', 'termination', 'progress']
+
+    @admin.display(description='progress')
+    def progress(self, obj: Job):
+        if not obj.progress_phase:
+            return '-'
+        result = f'{obj.progress_phase}: {obj.progress_processed}'
+        if obj.progress_total is not None:
+            result += f'/{obj.progress_total}'
+        rate = obj.progress_rate()
+        if rate is not None:
+            result += f' ({rate:.2f}/s'
+            eta = obj.progress_eta()
+            if eta is not None:
+                result += f', ETA {timezone.localtime(eta):%H:%M:%S}'
+            result += ')'
+        return result
 
     def has_add_permission(self, request):
         return False
@@ -1,6 +1,7 @@
 from django.utils import timezone
 from django.core.management.base import BaseCommand
 from spellbook.models import Job
+from spellbook.variants.variants_generator import Checkpoint
 
 
 class Command(BaseCommand):
@@ -23,3 +24,6 @@ class Command(BaseCommand):
             self.stdout.write(self.style.SUCCESS(f"{count} pending jobs were cancelled."))
         else:
             self.stdout.write(self.style.SUCCESS("No pending jobs to cancel."))
+        self.stdout.write('Cleaning stale checkpoints...')
+        deleted = Checkpoint.prune()
+        self.stdout.write(self.style.SUCCESS(f"{deleted} stale checkpoint files were deleted."))
@@ -0,0 +1,57 @@
+from pathlib import Path
+import traceback
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError
+from spellbook.models import Job
+from spellbook.variants.variant_data import Data
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Exports the catalog used by the variant generator to a binary snapshot file'
+
+    def add_arguments(self, parser):
+        # Named (optional) arguments
+        parser.add_argument(
+            '--file',
+            type=Path,
+            dest='file',
+            # The snapshot contains the not working variants, so it must not go to the publicly served bulk folder
+            default=Path(settings.VARIANTS_SNAPSHOT_FOLDER) / Path('catalog.snapshot')
+        )
+        parser.add_argument(
+            '--id',
+            type=int,
+            dest='job_id',
+        )
+
+    def handle(self, *args, **options):
+        job = None
+        if options['job_id']:
+            try:
+                job = Job.objects.get(id=options['job_id'])
+            except Job.DoesNotExist:
+                raise CommandError('Job with id %s does not exist' % options['job_id'])
+        try:
+            if options['file'] is None:
+                raise Exception('No file specified')
+            output: Path = options['file'].resolve()
+            self.stdout.write('Fetching catalog from db...')
+            data = Data()
+            self.stdout.write(f'Exporting catalog snapshot to {output}...')
+            output.parent.mkdir(parents=True, exist_ok=True)
+            data.save_snapshot(output)
+            self.stdout.write('Done')
+            if job is not None:
+                job.termination = timezone.now()
+                job.status = Job.Status.SUCCESS
+                job.message = f'Successfully exported a snapshot of {len(data.combo_ids)} combos'
+                job.save()
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(traceback.format_exc()))
+            message = f'Failed to export catalog snapshot: {e}'
+            if job is not None:
+                job.termination = timezone.now()
+                job.status = Job.Status.FAILURE
+                job.message = message
+                job.save()
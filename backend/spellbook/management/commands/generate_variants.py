@@ -1,8 +1,15 @@
+import json
 import traceback
+from typing import Optional
+from pathlib import Path
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from spellbook.models import Combo
-from spellbook.models import Job, Variant
-from spellbook.variants.variants_generator import generate_variants
+from spellbook.models import Job, Variant, Card, Feature
+from spellbook.variants.variants_generator import generate_variants, work_on_shards, explain_combo
+from spellbook.variants.combo_graph import ComboNode
+from spellbook.variants.profiler import Profiler
+from spellbook.variants.variant_trie import Budget
 from django.utils import timezone
 from django.contrib.admin.models import LogEntry, CHANGE
 from django.contrib.contenttypes.models import ContentType
@@ -18,26 +25,154 @@ class Command(BaseCommand):
             type=int,
             dest='job_id',
         )
+        parser.add_argument(
+            '--bottom-up',
+            action='store_true',
+            dest='bottom_up',
+            help='Precompute all tries bottom-up over the strongly connected components of the graph',
+        )
+        parser.add_argument(
+            '--parallel',
+            action='store_true',
+            dest='parallel',
+            help='Distribute the up steps of the variants among PARALLEL_SOLVERS worker processes, or whole generator combos with --bottom-up',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            help='Only recompute the generator combos affected by changes since the last successful generation',
+        )
+        parser.add_argument(
+            '--snapshot',
+            type=Path,
+            dest='snapshot',
+            help='Read the catalog from a snapshot file made by export_catalog_snapshot instead of the database',
+        )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            dest='stream',
+            help='Save variants in batches from a writer thread while the combos are still being processed, ignored by incremental generations',
+        )
+        parser.add_argument(
+            '--resume',
+            type=int,
+            dest='resume',
+            metavar='JOB_ID',
+            help='Continue from the last checkpoint of an interrupted generation job',
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            dest='shards',
+            help='Split the generator combos into this many shards for --worker processes to claim with the same mode and budget, then merge their results',
+        )
+        parser.add_argument(
+            '--worker',
+            action='store_true',
+            dest='worker',
+            help='Process the pending shards of sharded generations until none is left, then exit',
+        )
+        parser.add_argument(
+            '--explain',
+            type=int,
+            dest='explain',
+            metavar='COMBO_ID',
+            help='Only run the down and up step of a combo, printing the tree of visited features and combos with their cost, without saving anything',
+        )
+        parser.add_argument(
+            '--slowest',
+            type=int,
+            dest='slowest',
+            metavar='N',
+            help='Print the N generator combos that took the longest to process',
+        )
+        parser.add_argument(
+            '--max-trie-size',
+            type=int,
+            dest='max_trie_size',
+            default=settings.VARIANTS_COMBO_MAX_TRIE_SIZE,
+            help='Skip the combos that build a trie with more keys than this, keeping their existing variants',
+        )
+        parser.add_argument(
+            '--max-and-pairs',
+            type=int,
+            dest='max_and_pairs',
+            default=settings.VARIANTS_COMBO_MAX_AND_PAIRS,
+            help='Skip the combos that combine more pairs of keys than this, keeping their existing variants',
+        )
+        parser.add_argument(
+            '--max-combo-seconds',
+            type=float,
+            dest='max_combo_seconds',
+            default=settings.VARIANTS_COMBO_MAX_SECONDS,
+            help='Skip the combos that take longer than this, keeping their existing variants',
+        )
+        parser.add_argument(
+            '--dry-run',
+            type=Path,
+            nargs='?',
+            const=Path('variants_diff.json'),
+            dest='dry_run',
+            metavar='DIFF_FILE',
+            help='Compute variants and write what saving them would create, update and delete to DIFF_FILE (variants_diff.json by default) without writing to the database',
+        )
 
     def handle(self, *args, **options):
+        if options['explain'] is not None:
+            self.explain(options['explain'], options['snapshot'])
+            return
+        if options['worker']:
+            processed = work_on_shards(parallel=options['parallel'])
+            self.stdout.write(self.style.SUCCESS(f'Processed {processed} shards'))
+            return
+        if options['dry_run'] is not None:
+            if options['job_id'] or options['shards'] is not None or options['stream'] or options['resume'] is not None:
+                raise CommandError('--dry-run cannot be combined with --id, --shards, --stream or --resume')
+            self.dry_run(options)
+            return
+        if options['incremental'] and options['snapshot'] is not None:
+            raise CommandError('--incremental compares the database with the last generation, it cannot be combined with --snapshot')
         job = None
         if options['job_id']:
             try:
                 job = Job.objects.get(id=options['job_id'])
             except Job.DoesNotExist:
                 raise CommandError('Job with id %s does not exist' % options['job_id'])
+        if options['shards'] is not None:
+            if options['incremental'] or options['stream'] or options['resume'] is not None:
+                raise CommandError('--shards cannot be combined with --incremental, --stream or --resume')
+            if job is None:
+                job = Job.start(name='generate_variants', duration=timezone.timedelta(hours=6), user=None)
+                if job is None:
+                    raise CommandError('Variants generation is already running')
+        profiler = Profiler()
+        budget = self.budget(options)
+        skipped = dict[int, str]()
         try:
-            added, restored, removed = generate_variants(job)
+            added, restored, removed = generate_variants(job, bottom_up=options['bottom_up'], parallel=options['parallel'], incremental=options['incremental'], snapshot=options['snapshot'], stream=options['stream'], resume=options['resume'], shards=options['shards'], profiler=profiler, budget=budget, skipped=skipped)
             if added == 0 and removed == 0 and restored == 0:
                 message = 'Variants are already synced with'
             else:
                 message = f'Generated {added} new variants, restored {restored} variants, removed {removed} variants for'
-            message += ' all combos'
+            if skipped:
+                message += f' all combos except {len(skipped)} over budget, whose variants were kept:\n'
+                message += '\n'.join(f'Combo {combo_id}: {reason}' for combo_id, reason in skipped.items())
+            else:
+                message += ' all combos'
             self.stdout.write(self.style.SUCCESS(message))
+            self.stdout.write(profiler.summary())
+            if options['slowest']:
+                self.stdout.write(f'Slowest {options["slowest"]} combos:')
+                for combo_id, elapsed in profiler.slowest('combos', options['slowest']):
+                    self.stdout.write(f'Combo {combo_id}: {elapsed:.3f}s')
             if job is not None:
                 job.termination = timezone.now()
                 job.status = Job.Status.SUCCESS
                 job.message = message
+                job.profile = profiler.as_dict()
+                job.skipped = skipped
                 job.save()
                 if job.started_by is not None:
                     LogEntry(
@@ -53,4 +188,65 @@ class Command(BaseCommand):
                 job.termination = timezone.now()
                 job.status = Job.Status.FAILURE
                 job.message = message
+                job.profile = profiler.as_dict()
                 job.save()
+
+    def budget(self, options) -> Budget:
+        return Budget(max_trie_size=options['max_trie_size'], max_and_pairs=options['max_and_pairs'], max_seconds=options['max_combo_seconds'])
+
+    def dry_run(self, options):
+        profiler = Profiler()
+        skipped = dict[int, str]()
+        diff = dict()
+        try:
+            generate_variants(bottom_up=options['bottom_up'], parallel=options['parallel'], incremental=options['incremental'], snapshot=options['snapshot'], profiler=profiler, budget=self.budget(options), skipped=skipped, diff=diff)
+        except Exception as e:
+            raise CommandError(f'Failed to compute variants: {e}')
+        diff['skipped'] = skipped
+        with options['dry_run'].open('w') as f:
+            json.dump(diff, f, indent=1)
+        summary = diff['summary']
+        message = f'Would create {summary["created"]} variants, update {summary["updated"]} variants, of which {summary["restored"]} restored, ' \
+            f'delete {summary["deleted"]} variants, keep {summary["kept frozen"]} frozen variants and leave {summary["untouched"]} variants untouched'
+        if skipped:
+            message += f', skipping {len(skipped)} combos over budget'
+        self.stdout.write(self.style.SUCCESS(message))
+        self.stdout.write(f'Diff written to {options["dry_run"]}')
+        self.stdout.write(profiler.summary())
+
+    def explain(self, combo_id: int, snapshot: Optional[Path]):
+        try:
+            trace, variants = explain_combo(combo_id, snapshot)
+        except Exception as e:
+            raise CommandError(str(e))
+        card_names = dict(Card.objects.values_list('id', 'name'))
+        feature_names = dict(Feature.objects.values_list('id', 'name'))
+
+        def describe(node) -> str:
+            if isinstance(node, ComboNode):
+                if not node.cards:
+                    return f'Combo {node.id}'
+                return f'Combo {node.id} ({" + ".join(card_names.get(c, str(c)) for c in node.cards)})'
+            return f'Feature {node.id} ({feature_names.get(node.id, "?")})'
+        stack = [(entry, 0) for entry in reversed(trace.roots)]
+        while stack:
+            entry, depth = stack.pop()
+            line = f'{"  " * depth}{describe(entry.node)}: {entry.trie_size} keys, {entry.elapsed * 1000:.2f} ms'
+            if entry.reused:
+                line += ', computed before'
+            elif entry.cut:
+                line += ', cut by a cycle'
+            else:
+                line += f', {entry.pairs} pairs, {entry.pruned} pruned'
+                if entry.memoized:
+                    line += f', {entry.memoized} steps from the cache'
+            self.stdout.write(line)
+            stack.extend((child, depth + 1) for child in reversed(entry.children))
+        self.stdout.write(f'{len(variants)} variants:')
+        for variant in variants:
+            line = f'{variant.unique_id}: {" + ".join(card_names.get(c, str(c)) for c in variant.ingredients.cards)}, ' \
+                f'{len(variant.ingredients.features)} features, {len(variant.ingredients.combos)} combos, ' \
+                f'up step {variant.up_elapsed * 1000:.2f} ms'
+            if variant.not_working:
+                line += ', not working'
+            self.stdout.write(line)
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.2 on 2026-10-18 05:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0007_alter_template_scryfall_query'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('combo_ids', models.JSONField(help_text='Generator combos to process', verbose_name='generator combo ids')),
+                ('fingerprint', models.CharField(help_text='Fingerprint of the catalog the shard was created from', max_length=64)),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('C', 'Claimed'), ('D', 'Done'), ('F', 'Failure')], default='P', max_length=2)),
+                ('worker', models.CharField(blank=True, help_text='Worker that claimed this shard', max_length=255)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('message', models.TextField(blank=True)),
+                ('variants', models.JSONField(blank=True, help_text='Variants found by the worker, merged by the coordinator', null=True)),
+                ('job', models.ForeignKey(help_text='Variant generation job this shard belongs to', on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='spellbook.job')),
+            ],
+            options={
+                'verbose_name': 'generation shard',
+                'verbose_name_plural': 'generation shards',
+                'ordering': ['job', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.2 on 2026-10-18 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0008_generationshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='progress_phase',
+            field=models.CharField(blank=True, help_text='Phase the job is currently in', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress_processed',
+            field=models.PositiveIntegerField(default=0, help_text='Items processed in the current phase'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress_started',
+            field=models.DateTimeField(blank=True, help_text='Start of the current phase', null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress_total',
+            field=models.PositiveIntegerField(blank=True, help_text='Items to process in the current phase, if known', null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress_updated',
+            field=models.DateTimeField(blank=True, help_text='Last progress update', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0009_job_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='profile',
+            field=models.JSONField(blank=True, help_text='Time, memory and counters of each phase of the job', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 05:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0010_job_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationshard',
+            name='skipped',
+            field=models.JSONField(blank=True, help_text='Combos skipped for exceeding their budget, with the reason', null=True),
+        ),
+    ]
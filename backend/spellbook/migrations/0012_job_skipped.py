@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0011_generationshard_skipped'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='skipped',
+            field=models.JSONField(blank=True, help_text='Generator combos skipped for exceeding their budget, with the reason, retried by the next incremental generation', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.2 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spellbook', '0012_job_skipped'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationshard',
+            name='bottom_up',
+            field=models.BooleanField(default=False, help_text='Whether the tries are precomputed bottom-up, as chosen by the coordinator'),
+        ),
+        migrations.AddField(
+            model_name='generationshard',
+            name='budget',
+            field=models.JSONField(blank=True, help_text='Limits on the work of each combo chosen by the coordinator', null=True),
+        ),
+    ]
@@ -218,6 +218,13 @@ class Job(models.Model):
         verbose_name='variants updated',
         editable=False
     )
+    progress_phase = models.CharField(max_length=255, blank=True, help_text='Phase the job is currently in')
+    progress_processed = models.PositiveIntegerField(default=0, help_text='Items processed in the current phase')
+    progress_total = models.PositiveIntegerField(blank=True, null=True, help_text='Items to process in the current phase, if known')
+    progress_started = models.DateTimeField(blank=True, null=True, help_text='Start of the current phase')
+    progress_updated = models.DateTimeField(blank=True, null=True, help_text='Last progress update')
+    profile = models.JSONField(blank=True, null=True, help_text='Time, memory and counters of each phase of the job')
+    skipped = models.JSONField(blank=True, null=True, help_text='Generator combos skipped for exceeding their budget, with the reason, retried by the next incremental generation')
 
     def start(name: str, duration: timezone.timedelta, user: User):
         try:
@@ -234,6 +241,19 @@ class Job(models.Model):
         except OperationalError:
             return None
 
+    def progress_rate(self):
+        # Items processed per second in the current phase
+        if self.progress_started is None or self.progress_updated is None or self.progress_processed == 0:
+            return None
+        elapsed = (self.progress_updated - self.progress_started).total_seconds()
+        return self.progress_processed / elapsed if elapsed > 0 else None
+
+    def progress_eta(self):
+        rate = self.progress_rate()
+        if rate is None or self.progress_total is None:
+            return None
+        return self.progress_updated + timezone.timedelta(seconds=max(0, self.progress_total - self.progress_processed) / rate)
+
     class Meta:
         ordering = ['-created', 'name']
         verbose_name = 'job'
@@ -247,3 +267,35 @@ class Job(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class GenerationShard(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'P'
+        CLAIMED = 'C'
+        DONE = 'D'
+        FAILURE = 'F'
+    job = models.ForeignKey(
+        to=Job,
+        related_name='shards',
+        on_delete=models.CASCADE,
+        help_text='Variant generation job this shard belongs to')
+    combo_ids = models.JSONField(help_text='Generator combos to process', verbose_name='generator combo ids')
+    fingerprint = models.CharField(max_length=64, blank=False, help_text='Fingerprint of the catalog the shard was created from')
+    bottom_up = models.BooleanField(default=False, help_text='Whether the tries are precomputed bottom-up, as chosen by the coordinator')
+    budget = models.JSONField(blank=True, null=True, help_text='Limits on the work of each combo chosen by the coordinator')
+    status = models.CharField(choices=Status.choices, default=Status.PENDING, max_length=2, blank=False)
+    worker = models.CharField(max_length=255, blank=True, help_text='Worker that claimed this shard')
+    claimed = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    message = models.TextField(blank=True)
+    variants = models.JSONField(blank=True, null=True, help_text='Variants found by the worker, merged by the coordinator')
+    skipped = models.JSONField(blank=True, null=True, help_text='Combos skipped for exceeding their budget, with the reason')
+
+    class Meta:
+        ordering = ['job', 'id']
+        verbose_name = 'generation shard'
+        verbose_name_plural = 'generation shards'
+
+    def __str__(self):
+        return f'Shard {self.id} of job {self.job_id}'
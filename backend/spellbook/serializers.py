@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Card, Template, Feature, Combo, Variant
+from .models import Card, Template, Feature, Combo, Variant, Job
 
 
 class CardSerializer(serializers.ModelSerializer):
@@ -72,3 +72,27 @@ class VariantSerializer(serializers.ModelSerializer):
             'mana_needed',
             'other_prerequisites',
             'description']
+
+
+class JobSerializer(serializers.ModelSerializer):
+    progress_rate = serializers.FloatField(read_only=True)
+    progress_eta = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = Job
+        fields = [
+            'id',
+            'name',
+            'status',
+            'created',
+            'expected_termination',
+            'termination',
+            'progress_phase',
+            'progress_processed',
+            'progress_total',
+            'progress_rate',
+            'progress_eta',
+            'progress_updated',
+            'message',
+            'profile',
+            'skipped']
@@ -1,17 +1,21 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from .models import Combo, Variant
+from .variants.variant_text import TEXT_FIELDS, load_combo_texts, assemble_variant_text
 
 
 @receiver(post_save, sender=Combo)
 def update_new_variants(sender, instance: Combo, created, raw, **kwargs):
     if not raw and not created:
-        for variant in instance.variants.filter(status__in=[Variant.Status.NEW, Variant.Status.RESTORE]):
-            combos = variant.includes.all()
-            variant.zone_locations = '\n'.join(c.zone_locations for c in combos if len(c.zone_locations) > 0)
-            variant.cards_state = '\n'.join(c.cards_state for c in combos if len(c.cards_state) > 0)
-            variant.other_prerequisites = '\n'.join(c.other_prerequisites for c in combos if len(c.other_prerequisites) > 0)
-            variant.mana_needed = ' '.join(c.mana_needed for c in combos if len(c.mana_needed) > 0)
-            variant.description = '\n'.join(c.description for c in combos if len(c.description) > 0)
+        variants = list(instance.variants.filter(status__in=[Variant.Status.NEW, Variant.Status.RESTORE]))
+        included_ids = dict[int, list[int]]((variant.id, []) for variant in variants)
+        for variant_id, combo_id in Variant.includes.through.objects.filter(variant__in=variants).values_list('variant_id', 'combo_id'):
+            included_ids[variant_id].append(combo_id)
+        combo_texts = load_combo_texts(Combo.objects.filter(included_in_variants__in=variants).distinct())
+        now = timezone.now()
+        for variant in variants:
+            assemble_variant_text(variant, included_ids[variant.id], combo_texts)
             variant.status = Variant.Status.NEW
-            variant.save()
+            variant.updated = now
+        Variant.objects.bulk_update(variants, [*TEXT_FIELDS, 'status', 'updated'])
@@ -1,3 +1,429 @@
-from django.test import TestCase
+import random
+import tempfile
+from pathlib import Path
+import logging
+import os
+import subprocess
+import sys
+from unittest import mock
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from .models import Card, Feature, Template, Combo, Variant, Job, GenerationShard
+from .variants import variants_generator
+from .variants.variants_generator import generate_variants, find_variants, get_variants_from_graph, variant_definition_to_json, Checkpoint
+from .variants.variant_data import Data
+from .variants.combo_graph import Graph
+from .variants.variant_trie import VariantTrie, SubsetIndex, TrieCache, TrieStatistics, Budget, BudgetExceeded, and_tries, or_tries
 
-# Create your tests here.
+
+def trie_keys(trie: VariantTrie) -> set[frozenset[tuple[str, int]]]:
+    return {frozenset([('card', c) for c in cards] + [('template', t) for t in templates]) for cards, templates in trie.variants()}
+
+
+def minimal_family(keys: set[frozenset], limit: int) -> set[frozenset]:
+    # Brute-force reference: the keys within the limit that have no strict subset among them
+    keys = {key for key in keys if len(key) <= limit}
+    return {key for key in keys if not any(other < key for other in keys)}
+
+
+def random_key(r: random.Random) -> frozenset[tuple[str, int]]:
+    cards = r.sample(range(1, 10), r.randint(1, 4))
+    templates = r.sample(range(1, 4), r.choice([0, 0, 1]))
+    return frozenset([('card', c) for c in cards] + [('template', t) for t in templates])
+
+
+def build_trie(keys: set[frozenset[tuple[str, int]]], limit: int) -> VariantTrie:
+    trie = VariantTrie(limit=limit)
+    for key in keys:
+        trie.add([i for kind, i in key if kind == 'card'], [i for kind, i in key if kind == 'template'])
+    return trie
+
+
+class SubsetIndexTests(SimpleTestCase):
+    def test_subset_and_superset_queries(self):
+        index = SubsetIndex()
+        for key in ({1, 2}, {2, 3, 4}, {5}):
+            index.add(frozenset(key))
+        self.assertTrue(index.contains_subset_of(frozenset({1, 2, 3})))
+        self.assertTrue(index.contains_subset_of(frozenset({5, 6})))
+        self.assertFalse(index.contains_subset_of(frozenset({1, 3, 4})))
+        self.assertEqual(index.supersets_of(frozenset({2})), {frozenset({1, 2}), frozenset({2, 3, 4})})
+        self.assertEqual(index.supersets_of(frozenset({3, 6})), set())
+        index.remove(frozenset({1, 2}))
+        self.assertFalse(index.contains_subset_of(frozenset({1, 2, 3})))
+        self.assertEqual(len(index), 2)
+
+    def test_queries_match_brute_force(self):
+        r = random.Random(0)
+        for _ in range(200):
+            keys = {frozenset(r.sample(range(12), r.randint(1, 5))) for _ in range(r.randint(0, 30))}
+            index = SubsetIndex()
+            for key in keys:
+                index.add(key)
+            query = frozenset(r.sample(range(12), r.randint(0, 8)))
+            self.assertEqual(index.contains_subset_of(query), any(key <= query for key in keys))
+            self.assertEqual(index.supersets_of(query), {key for key in keys if query <= key})
+
+    def test_index_is_linear_in_the_key_lengths(self):
+        # The rotation-based trie stored every rotation of every key, about the sum of the squared key lengths,
+        # while the index stores every key once plus one reference to it per item
+        r = random.Random(3)
+        keys = {frozenset(r.sample(range(40), r.randint(3, 8))) for _ in range(200)}
+        index = SubsetIndex()
+        for key in keys:
+            index.add(key)
+        stored = sum(len(key) for key in index.keys) + sum(len(postings) for postings in index.keys_by_item.values())
+        self.assertEqual(stored, 2 * sum(len(key) for key in keys))
+        self.assertLess(stored, sum(len(key) ** 2 for key in keys) / 2)
+
+
+class VariantTrieTests(SimpleTestCase):
+    def test_non_minimal_supersets_are_dropped(self):
+        trie = VariantTrie()
+        trie.add([1, 2, 3, 4], [])
+        trie.add([1, 2, 3, 4], [1])
+        self.assertEqual(trie.variants(), [([1, 2, 3, 4], [])])
+        # A subset that is not contiguous in the sorted key replaces its superset
+        trie.add([1, 3], [])
+        self.assertEqual(trie.variants(), [([1, 3], [])])
+        trie.add([1, 3, 5], [])
+        trie.add([3, 1], [2])
+        self.assertEqual(trie.variants(), [([1, 3], [])])
+        trie.add([2], [1])
+        self.assertCountEqual(trie.variants(), [([1, 3], []), ([2], [1])])
+
+    def test_limit_drops_longer_keys(self):
+        trie = VariantTrie(limit=2)
+        trie.add([1, 2, 3], [])
+        trie.add([1], [1, 2])
+        self.assertEqual(trie.variants(), [])
+        left = build_trie({frozenset({('card', 1), ('card', 2)})}, limit=3)
+        right = build_trie({frozenset({('card', 3), ('card', 4)}), frozenset({('card', 2), ('card', 5)})}, limit=3)
+        self.assertEqual(trie_keys(left & right), {frozenset({('card', 1), ('card', 2), ('card', 5)})})
+
+    def test_operations_match_minimal_family(self):
+        r = random.Random(1)
+        for _ in range(300):
+            limit = r.randint(2, 6)
+            left_keys = {random_key(r) for _ in range(r.randint(0, 8))}
+            right_keys = {random_key(r) for _ in range(r.randint(0, 8))}
+            left = build_trie(left_keys, limit)
+            right = build_trie(right_keys, limit)
+            self.assertEqual(trie_keys(left), minimal_family(left_keys, limit))
+            self.assertEqual(trie_keys(left | right), minimal_family(left_keys | right_keys, limit))
+            self.assertEqual(trie_keys(left & right), minimal_family({a | b for a in left_keys for b in right_keys}, limit))
+
+    def test_deadline_is_checked_within_an_and(self):
+        left = build_trie({frozenset({('card', i)}) for i in range(1, 201)}, limit=2)
+        right = build_trie({frozenset({('card', i)}) for i in range(201, 401)}, limit=2)
+        budget = Budget(max_seconds=0)
+        with self.assertRaises(BudgetExceeded):
+            left._and(right, limit=2, budget=budget)
+        self.assertEqual(len(left._and(right, limit=2, budget=Budget())), 40000)
+
+    def test_memoized_steps_keep_their_pairs(self):
+        tries = [build_trie({frozenset({('card', i)}), frozenset({('card', i + 10)})}, limit=5) for i in range(1, 4)]
+        cache = TrieCache()
+        statistics = TrieStatistics()
+        first = and_tries(tries, limit=5, statistics=statistics, cache=cache)
+        second = and_tries(tries, limit=5, statistics=statistics, cache=cache)
+        self.assertIs(first, second)
+        computed, memoized = statistics.records
+        self.assertEqual((computed.pairs, computed.memo_hits, computed.memoized_pairs), (12, 0, 0))
+        self.assertEqual((memoized.pairs, memoized.memo_hits, memoized.memoized_pairs), (0, 2, 12))
+
+    def test_aggregations_match_minimal_family(self):
+        r = random.Random(2)
+        cache = TrieCache(max_keys=20)
+        for _ in range(200):
+            limit = r.randint(2, 6)
+            families = [{random_key(r) for _ in range(r.randint(0, 5))} for _ in range(r.randint(1, 4))]
+            tries = [build_trie(keys, limit) for keys in families]
+            union = set().union(*families)
+            product_keys = {frozenset()}
+            for keys in families:
+                product_keys = {a | b for a in product_keys for b in keys}
+            for aggregation_cache in (None, cache):
+                self.assertEqual(trie_keys(or_tries(tries, limit=limit, cache=aggregation_cache)), minimal_family(union, limit))
+                self.assertEqual(trie_keys(and_tries(tries, limit=limit, cache=aggregation_cache)), minimal_family(product_keys, limit))
+            self.assertLessEqual(cache.keys, cache.max_keys)
+            self.assertEqual(cache.keys, sum(TrieCache._entry_keys(result, operands) for result, operands, _ in cache.memo.values()))
+
+
+def create_random_catalog(seed: int, cards: int = 25, features: int = 12, templates: int = 3, combos: int = 40):
+    r = random.Random(seed)
+    card_list = [Card.objects.create(name=f'Card {i}', identity=''.join(c for c in 'WUBRG' if r.random() < 0.3)) for i in range(cards)]
+    feature_list = [Feature.objects.create(name=f'Feature {i}', utility=r.random() < 0.1) for i in range(features)]
+    template_list = [Template.objects.create(name=f'Template {i}', scryfall_query='t:creature') for i in range(templates)]
+    for feature in feature_list:
+        feature.cards.set(r.sample(card_list, r.choice([0, 0, 1, 2, 3])))
+    for i in range(combos):
+        combo = Combo.objects.create(generator=r.random() < 0.6, description=f'Combo {i}')
+        combo.uses.set(r.sample(card_list, r.choice([0, 1, 1, 2, 3])))
+        combo.needs.set(r.sample(feature_list, r.choice([0, 1, 1, 2])))
+        if not combo.uses.exists() and not combo.needs.exists():
+            # Combos made only of templates
+            combo.requires.set(r.sample(template_list, 1))
+        else:
+            combo.requires.set(r.sample(template_list, r.choice([0, 0, 0, 1])))
+        combo.produces.set(r.sample(feature_list, r.choice([1, 1, 2])))
+
+
+class ReferenceClosure:
+    # Naive fixpoint of the up step: combos are reached from the cards and from the features enabled so far,
+    # and fire once all of their cards, templates and needed features are there
+    def __init__(self):
+        self.combos = {
+            combo.id: (
+                {c.id for c in combo.uses.all()},
+                {t.id for t in combo.requires.all()},
+                {f.id for f in combo.needs.all()},
+                {f.id for f in combo.produces.all()})
+            for combo in Combo.objects.prefetch_related('uses', 'requires', 'needs', 'produces')}
+        self.card_features = dict[int, set[int]]()
+        for card_id, feature_id in Card.features.through.objects.values_list('card_id', 'feature_id'):
+            self.card_features.setdefault(card_id, set()).add(feature_id)
+
+    def __call__(self, card_ids: set[int], template_ids: set[int]) -> tuple[set[int], set[int]]:
+        feature_ids = set[int]().union(*(self.card_features.get(card_id, set()) for card_id in card_ids))
+        fired = set[int]()
+        changed = True
+        while changed:
+            changed = False
+            for combo_id, (uses, requires, needs, produces) in self.combos.items():
+                reached = not uses.isdisjoint(card_ids) or not needs.isdisjoint(feature_ids)
+                if combo_id not in fired and reached and uses <= card_ids and requires <= template_ids and needs <= feature_ids:
+                    fired.add(combo_id)
+                    feature_ids.update(produces)
+                    changed = True
+        return feature_ids, fired
+
+
+class UpStepTests(TestCase):
+    def test_template_only_combos_are_not_reached(self):
+        card = Card.objects.create(name='Card')
+        template = Template.objects.create(name='Template', scryfall_query='t:creature')
+        feature = Feature.objects.create(name='Feature')
+        template_only = Combo.objects.create(description='Template only')
+        template_only.requires.add(template)
+        template_only.produces.add(feature)
+        generator = Combo.objects.create(generator=True, description='Generator')
+        generator.uses.add(card)
+        generator.requires.add(template)
+        generator.produces.add(Feature.objects.create(name='Other feature'))
+        ingredients = Graph(Data()).up([card.id], [template.id])
+        self.assertEqual(ingredients.combos, [generator.id])
+        self.assertNotIn(feature.id, ingredients.features)
+
+    def test_up_step_matches_reference_closure(self):
+        create_random_catalog(seed=1)
+        r = random.Random(1)
+        card_ids = sorted(Card.objects.values_list('id', flat=True))
+        template_ids = sorted(Template.objects.values_list('id', flat=True))
+        decks = [(set(r.sample(card_ids, r.randint(1, 12))), set(r.sample(template_ids, r.randint(0, 2)))) for _ in range(40)]
+        data = Data()
+        for bottom_up in (False, True):
+            graph = Graph(data)
+            if bottom_up:
+                graph.precompute_tries()
+            for combo_id in data.generator_combo_ids:
+                for cards, templates in graph.down(combo_id).variants():
+                    decks.append((set(cards), set(templates)))
+        graph = Graph(data)
+        reference_closure = ReferenceClosure()
+        for cards, templates in decks:
+            ingredients = graph.up(sorted(cards), sorted(templates))
+            self.assertEqual((set(ingredients.features), set(ingredients.combos)), reference_closure(cards, templates))
+
+
+class SnapshotTests(TestCase):
+    def test_snapshot_round_trip(self):
+        create_random_catalog(seed=3)
+        data = Data()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'catalog.snapshot'
+            data.save_snapshot(path)
+            loaded = Data(path)
+        self.assertEqual(loaded.fingerprint(), data.fingerprint())
+        self.assertEqual(list(loaded.combo_ids), list(data.combo_ids))
+        self.assertEqual(list(loaded.combo_needs), list(data.combo_needs))
+        self.assertEqual(set(loaded.not_working_variants), set(data.not_working_variants))
+        graph, loaded_graph = Graph(data), Graph(loaded)
+        for combo_id in data.generator_combo_ids:
+            self.assertEqual(loaded_graph.down(combo_id).variants(), graph.down(combo_id).variants())
+
+
+class BottomUpTests(TestCase):
+    def test_cyclic_components_reach_the_fixpoint_within_budget(self):
+        create_random_catalog(seed=6, cards=30, features=20, combos=120)
+        data = Data()
+        graph = Graph(data)
+        self.assertGreater(max(len(component) for component in graph._strongly_connected_components()), 20)
+        # Evaluating every node again from all of its operands until the fixpoint needs several times as many pairs
+        graph.budget = Budget(max_and_pairs=300000, max_seconds=60)
+        graph.precompute_tries()
+        self.assertEqual(graph.over_budget, {})
+        # Naive reference: every node is evaluated again from all of its operands until none changes
+        reference = Graph(data)
+        nodes = list(reference.fnodes.values()) + list(reference.bnodes.values())
+        for node in nodes:
+            node.trie = VariantTrie(limit=5)
+        changed = True
+        while changed:
+            changed = False
+            for node in nodes:
+                trie = reference._evaluate_trie(node)
+                if trie.index.keys != node.trie.index.keys:
+                    node.trie = trie
+                    changed = True
+        for combo_id in data.combo_ids:
+            self.assertEqual(graph.bnodes[combo_id].trie.index.keys, reference.bnodes[combo_id].trie.index.keys)
+        for feature_id in data.feature_ids:
+            self.assertEqual(graph.fnodes[feature_id].trie.index.keys, reference.fnodes[feature_id].trie.index.keys)
+
+
+def variants_snapshot() -> dict[str, tuple]:
+    return {
+        variant.unique_id: (
+            variant.status,
+            variant.identity,
+            tuple(c.id for c in variant.uses.all()),
+            frozenset(t.id for t in variant.requires.all()),
+            frozenset(c.id for c in variant.of.all()),
+            frozenset(c.id for c in variant.includes.all()),
+            tuple(f.id for f in variant.produces.all()),
+            variant.description)
+        for variant in Variant.objects.prefetch_related('uses', 'requires', 'of', 'includes', 'produces')}
+
+
+class IncrementalGenerationTests(TestCase):
+    def setUp(self):
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_combos_skipped_by_the_last_generation_are_retried(self):
+        create_random_catalog(seed=4)
+        job = Job.start(name='generate_variants', duration=timezone.timedelta(hours=1), user=None)
+        skipped = dict[int, str]()
+        generate_variants(job, bottom_up=True, budget=Budget(max_trie_size=1), skipped=skipped)
+        self.assertTrue(skipped)
+        job.status = Job.Status.SUCCESS
+        job.skipped = skipped
+        job.save()
+        generate_variants(bottom_up=True, incremental=True)
+        incremental = variants_snapshot()
+        Variant.objects.all().delete()
+        generate_variants(bottom_up=True)
+        self.assertEqual(variants_snapshot(), incremental)
+
+    def test_incremental_generation_cannot_use_a_snapshot(self):
+        with self.assertRaises(Exception):
+            generate_variants(incremental=True, snapshot=Path('catalog.snapshot'))
+
+
+class ParallelGenerationTests(TestCase):
+    def setUp(self):
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    @override_settings(PARALLEL_SOLVERS=2)
+    def test_parallel_generation_matches_the_serial_one(self):
+        create_random_catalog(seed=7, combos=60)
+        data = Data()
+        for bottom_up in (False, True):
+            serial = get_variants_from_graph(data, bottom_up=bottom_up)
+            parallel = get_variants_from_graph(data, bottom_up=bottom_up, parallel=True)
+            self.assertEqual(list(parallel.keys()), list(serial.keys()))
+            self.assertEqual(parallel, serial)
+
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_resumed_generation_matches_a_full_one(self):
+        create_random_catalog(seed=5, combos=80)
+        data = Data()
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / 'checkpoint.json'
+            for bottom_up in (False, True):
+                mode = dict(bottom_up=bottom_up, incremental=False)
+                checkpoint = Checkpoint(path, data.fingerprint(), mode=mode)
+                interrupted = find_variants(data, bottom_up=bottom_up, checkpoint=checkpoint)
+                for _ in range(len(data.generator_combo_ids) // 2):
+                    next(interrupted)
+                interrupted.close()
+                checkpoint.save()
+                resumed = Checkpoint(path, data.fingerprint(), mode=mode)
+                self.assertTrue(resumed.resume_from(path))
+                self.assertEqual(
+                    {unique_id: variant_definition_to_json(variant_def) for unique_id, variant_def in get_variants_from_graph(data, bottom_up=bottom_up, checkpoint=resumed).items()},
+                    {unique_id: variant_definition_to_json(variant_def) for unique_id, variant_def in get_variants_from_graph(data, bottom_up=bottom_up).items()})
+                with self.assertRaises(Exception):
+                    Checkpoint(path, data.fingerprint(), mode=dict(bottom_up=not bottom_up, incremental=False)).resume_from(path)
+
+
+class ShardedGenerationTests(TransactionTestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def generate_with_worker_process(self, **kwargs) -> tuple[int, int, int]:
+        # Runs a sharded generation whose shards are all processed by a generate_variants --worker process
+        job = Job.start(name='generate_variants', duration=timezone.timedelta(hours=1), user=None)
+        env = dict(os.environ, SQL_DATABASE=str(connection.settings_dict['NAME']))
+        worker = None
+        with tempfile.TemporaryFile('w+') as log:
+            def coordinator_work(*args, **kwargs) -> int:
+                # The coordinator does not process shards itself, so that the worker has to:
+                # it starts the worker once the shards exist and stops waiting if the worker failed
+                nonlocal worker
+                if worker is None:
+                    worker = subprocess.Popen([sys.executable, 'manage.py', 'generate_variants', '--worker'], cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+                elif worker.poll():
+                    log.seek(0)
+                    raise AssertionError(f'The worker failed:\n{log.read()}')
+                return 0
+            try:
+                with mock.patch.object(variants_generator, 'work_on_shards', side_effect=coordinator_work), mock.patch.object(variants_generator, 'SHARD_POLL_INTERVAL', 0.05):
+                    result = generate_variants(job, shards=3, **kwargs)
+            finally:
+                if worker is not None:
+                    worker.wait()
+            log.seek(0)
+            self.assertIn('Processed 3 shards', log.read())
+        self.assertFalse(GenerationShard.objects.exists())
+        job.status = Job.Status.SUCCESS
+        job.termination = timezone.now()
+        job.save()
+        return result
+
+    def test_worker_process_matches_a_full_run(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('The worker process cannot open an in-memory test database')
+        create_random_catalog(seed=2)
+        for bottom_up in (False, True):
+            with self.subTest(bottom_up=bottom_up):
+                Variant.objects.all().delete()
+                skipped = dict[int, str]()
+                added, restored, deleted = self.generate_with_worker_process(bottom_up=bottom_up, budget=Budget(max_trie_size=8), skipped=skipped)
+                self.assertGreater(added, 0)
+                self.assertTrue(skipped)
+                sharded = variants_snapshot()
+                Variant.objects.all().delete()
+                full_skipped = dict[int, str]()
+                generate_variants(bottom_up=bottom_up, budget=Budget(max_trie_size=8), skipped=full_skipped)
+                self.assertEqual(variants_snapshot(), sharded)
+                # The reasons name the first node over budget, which can differ between shards
+                self.assertEqual(full_skipped.keys(), skipped.keys())
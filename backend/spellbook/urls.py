@@ -8,6 +8,7 @@ router.register(r'features', views.FeatureViewSet, basename='features')
 router.register(r'combos', views.ComboViewSet, basename='combos')
 router.register(r'cards', views.CardViewSet, basename='cards')
 router.register(r'templates', views.TemplateViewSet, basename='templates')
+router.register(r'jobs', views.JobViewSet, basename='jobs')
 
 urlpatterns = [
     path('', include(router.urls))
@@ -1,12 +1,16 @@
 from datetime import timedelta
+import time
 import pathlib
+from typing import Optional
 import subprocess
 import sys
 from django.utils import timezone
 from django.core.management import call_command
+from django.db import transaction
 from django.db.models import Avg, F
 from .models import Job
 from django.conf import settings
+from collections import deque
 
 ASYNC_MODE = True
 
@@ -55,3 +59,51 @@ def launch_job_command(command: str, duration: timedelta, user, args: list[str]
                 raise e
         return True
     return False
+
+
+class JobProgress:
+    """
+    Reports the progress of a job, if any, in its progress fields and in the tail of its message.
+    Updates are saved at most every interval seconds, or every given number of processed items,
+    so that long loops do not commit once per item.
+    """
+    PROGRESS_FIELDS = ['progress_phase', 'progress_processed', 'progress_total', 'progress_started', 'progress_updated', 'message']
+
+    def __init__(self, job: Optional[Job], interval: float = settings.JOB_PROGRESS_INTERVAL, every: Optional[int] = None, tail: int = settings.JOB_MESSAGE_TAIL):
+        self.job = job
+        self.interval = interval
+        self.every = every
+        self.lines = deque(job.message.splitlines() if job is not None else [], maxlen=tail)
+        self.last_save = time.monotonic()
+        self.last_saved_processed = 0
+
+    def phase(self, name: str, total: Optional[int] = None, message: Optional[str] = None):
+        if self.job is None:
+            return
+        self.job.progress_phase = name
+        self.job.progress_processed = 0
+        self.job.progress_total = total
+        self.job.progress_started = timezone.now()
+        if message is not None:
+            self.lines.append(message)
+        self.save()
+
+    def advance(self, count: int = 1, message: Optional[str] = None):
+        if self.job is None:
+            return
+        self.job.progress_processed += count
+        if message is not None:
+            self.lines.append(message)
+        if time.monotonic() - self.last_save >= self.interval \
+                or self.every is not None and self.job.progress_processed - self.last_saved_processed >= self.every:
+            self.save()
+
+    def save(self):
+        if self.job is None:
+            return
+        self.job.progress_updated = timezone.now()
+        self.job.message = ''.join(line + '\n' for line in self.lines)
+        with transaction.atomic(durable=True):
+            self.job.save(update_fields=self.PROGRESS_FIELDS)
+        self.last_save = time.monotonic()
+        self.last_saved_processed = self.job.progress_processed
@@ -1,9 +1,12 @@
-from typing import Iterable, Optional
+import time
+from itertools import chain
+from typing import Iterable, Optional, TYPE_CHECKING
 from enum import Enum
-from ..models import Card, Feature, Combo, Template
-from .variant_data import Data
-from .variant_trie import VariantTrie, and_tries, or_tries
-from dataclasses import dataclass
+from .variant_trie import VariantTrie, TrieStatistics, TrieCache, Aggregation, Budget, BudgetExceeded, and_tries, or_tries
+from dataclasses import dataclass, field
+if TYPE_CHECKING:
+    # Not imported at runtime, so that worker processes can load the graph without the Django models
+    from .variant_data import Data
 
 MAX_CARDS_IN_COMBO = 5
 
@@ -15,218 +18,446 @@ class NodeState(Enum):
 
 
 class Node:
-    def __init__(self):
-        self.state: NodeState = NodeState.NOT_VISITED
+    # Nodes are linked to each other through tuples of ids, resolved by the graph.
+    # The state of a node is only meaningful if its epoch matches the graph's current one.
+    __slots__ = ('id', 'state', 'epoch', 'trie')
+
+    def __init__(self, id: int):
+        self.id = id
+        self.state = NodeState.NOT_VISITED
+        self.epoch = 0
         self.trie: Optional[VariantTrie] = None
 
     def __str__(self) -> str:
-        return f'{self.__class__} of {self._item()}'
-
-    def _item(self):
-        return None
+        return f'{self.__class__.__name__} of {self.id}'
 
 
 class CardNode(Node):
-    def __init__(self, card: Card, features: Iterable['FeatureNode'] = [], combos: Iterable['ComboNode'] = []):
-        super().__init__()
-        self.card = card
-        self.features = list(features)
-        self.combos = list(combos)
-
-    def __hash__(self):
-        return hash(self.card) + 7 * hash('card')
+    __slots__ = ('features', 'combos')
 
-    def _item(self):
-        return self.card
+    def __init__(self, id: int, features: Iterable[int] = (), combos: Iterable[int] = ()):
+        super().__init__(id)
+        self.features = tuple(features)
+        self.combos = tuple(combos)
 
 
 class TemplateNode(Node):
-    def __init__(self, template: Template, combos: Iterable['ComboNode'] = []):
-        super().__init__()
-        self.template = template
-        self.combos = list(combos)
+    __slots__ = ('combos',)
 
-    def __hash__(self):
-        return hash(self.template) + 7 * hash('template')
-
-    def _item(self):
-        return self.template
+    def __init__(self, id: int, combos: Iterable[int] = ()):
+        super().__init__(id)
+        self.combos = tuple(combos)
 
 
 class FeatureNode(Node):
-    def __init__(self, feature: Feature, cards: Iterable[CardNode] = [], produced_by_combos: Iterable['ComboNode'] = [], needed_by_combos: Iterable['ComboNode'] = []):
-        super().__init__()
-        self.feature = feature
-        self.cards = list[CardNode](cards)
-        self.produced_by_combos = list(produced_by_combos)
-        self.needed_by_combos = list(needed_by_combos)
-
-    def __hash__(self):
-        return hash(self.feature) + 7 * hash('feature')
+    __slots__ = ('cards', 'produced_by_combos', 'needed_by_combos')
 
-    def _item(self):
-        return self.feature
+    def __init__(self, id: int, cards: Iterable[int] = (), produced_by_combos: Iterable[int] = (), needed_by_combos: Iterable[int] = ()):
+        super().__init__(id)
+        self.cards = tuple(cards)
+        self.produced_by_combos = tuple(produced_by_combos)
+        self.needed_by_combos = tuple(needed_by_combos)
 
 
 class ComboNode(Node):
-    def __init__(self, combo: Combo, cards: Iterable[CardNode] = [], templates: Iterable[TemplateNode] = [], features_needed: Iterable[FeatureNode] = [], features_produced: Iterable[FeatureNode] = []):
-        super().__init__()
-        self.combo = combo
-        self.cards = list(cards)
-        self.templates = list(templates)
-        self.features_needed = list(features_needed)
-        self.features_produced = list(features_produced)
+    __slots__ = ('cards', 'templates', 'features_needed', 'features_produced')
 
-    def __hash__(self):
-        return hash(self.combo) + 7 * hash('combo')
-
-    def _item(self):
-        return self.combo
+    def __init__(self, id: int, cards: Iterable[int] = (), templates: Iterable[int] = (), features_needed: Iterable[int] = (), features_produced: Iterable[int] = ()):
+        super().__init__(id)
+        self.cards = tuple(cards)
+        self.templates = tuple(templates)
+        self.features_needed = tuple(features_needed)
+        self.features_produced = tuple(features_produced)
 
 
 @dataclass(frozen=True)
 class VariantIngredients:
-    cards: list[Card]
-    templates: list[Template]
-    features: list[Feature]
-    combos: list[Combo]
+    cards: list[int]
+    templates: list[int]
+    features: list[int]
+    combos: list[int]
+
+
+@dataclass
+class TraceEntry:
+    node: Node
+    children: list['TraceEntry'] = field(default_factory=list)
+    trie_size: int = 0
+    elapsed: float = 0.0
+    # Pairs of keys combined by the AND of a combo, or keys merged by the OR of a feature,
+    # and how many of them did not end up in the trie
+    pairs: int = 0
+    pruned: int = 0
+    # Aggregation steps served from the memo of the cache, whose pairs are the ones of their first computation
+    memoized: int = 0
+    # Whether the trie was computed before the node was visited, or the node was cut because of a cycle
+    reused: bool = False
+    cut: bool = False
+
+
+class DownTrace:
+    # Records the tree of nodes visited by the down step, with the cost of each node
+    def __init__(self, statistics: TrieStatistics):
+        self.statistics = statistics
+        self.roots = list[TraceEntry]()
+        self.stack = list[TraceEntry]()
+
+    def current(self) -> Optional[Node]:
+        return self.stack[-1].node if self.stack else None
+
+    def visit(self, node: Node, down) -> VariantTrie:
+        entry = TraceEntry(node, reused=node.trie is not None)
+        (self.stack[-1].children if self.stack else self.roots).append(entry)
+        start = time.perf_counter()
+        self.stack.append(entry)
+        try:
+            trie = down(node)
+        finally:
+            self.stack.pop()
+        entry.elapsed = time.perf_counter() - start
+        entry.trie_size = len(trie)
+        if not entry.reused:
+            if node.trie is None:
+                entry.cut = True
+            else:
+                # The aggregation of a node is the last one, after those of its children
+                record = self.statistics.records[-1]
+                entry.pairs = record.pairs + record.memoized_pairs if record.strategy == Aggregation.AND else sum(record.operand_sizes)
+                entry.pruned = max(0, entry.pairs - record.result_size)
+                entry.memoized = record.memo_hits
+        return trie
+
+
+def group_pairs(pairs: Iterable[tuple[int, int]]) -> dict[int, list[int]]:
+    result = dict[int, list[int]]()
+    for key, value in pairs:
+        result.setdefault(key, []).append(value)
+    return result
 
 
 class Graph:
-    def __init__(self, data: Data):
+    def __init__(self, data: 'Data'):
         if data is not None:
-            self.data = data
-            self.cnodes = dict[int, CardNode]((card.id, CardNode(card, [], [])) for card in data.cards)
+            self.statistics = TrieStatistics()
+            self.cache = TrieCache()
+            self.trace: Optional[DownTrace] = None
+            self.budget: Optional[Budget] = None
+            # Reasons why the tries of some nodes could not be computed within the budget
+            self.over_budget = dict[Node, str]()
+            self.epoch = 0
+            card_features = dict[int, list[int]]((card_id, []) for card_id in data.card_ids)
+            card_combos = dict[int, list[int]]((card_id, []) for card_id in data.card_ids)
+            template_combos = dict[int, list[int]]((template_id, []) for template_id in data.template_ids)
+            feature_cards = dict[int, list[int]]((feature_id, []) for feature_id in data.feature_ids)
+            feature_produced_by = dict[int, list[int]]((feature_id, []) for feature_id in data.feature_ids)
+            feature_needed_by = dict[int, list[int]]((feature_id, []) for feature_id in data.feature_ids)
+            for feature_id, card_id in data.feature_cards:
+                feature_cards[feature_id].append(card_id)
+                card_features[card_id].append(feature_id)
+            combo_cards = group_pairs(data.combo_cards)
+            combo_templates = group_pairs(data.combo_templates)
+            combo_needs = group_pairs(data.combo_needs)
+            combo_produces = group_pairs(data.combo_produces)
+            self.bnodes = dict[int, ComboNode]()
+            for combo_id in data.combo_ids:
+                node = ComboNode(combo_id,
+                    cards=combo_cards.get(combo_id, ()),
+                    templates=combo_templates.get(combo_id, ()),
+                    features_needed=combo_needs.get(combo_id, ()),
+                    features_produced=combo_produces.get(combo_id, ()))
+                self.bnodes[combo_id] = node
+                for feature_id in node.features_produced:
+                    feature_produced_by[feature_id].append(combo_id)
+                for feature_id in node.features_needed:
+                    feature_needed_by[feature_id].append(combo_id)
+                for card_id in node.cards:
+                    card_combos[card_id].append(combo_id)
+                for template_id in node.templates:
+                    template_combos[template_id].append(combo_id)
+            self.cnodes = dict[int, CardNode]((card_id, CardNode(card_id, card_features[card_id], card_combos[card_id])) for card_id in card_features)
             for c in self.cnodes.values():
                 c.trie = VariantTrie(limit=MAX_CARDS_IN_COMBO)
-                c.trie.add([c.card.id], [])
-            self.tnodes = dict[int, TemplateNode]((template.id, TemplateNode(template, [])) for template in data.templates)
+                c.trie.add([c.id], [])
+            self.tnodes = dict[int, TemplateNode]((template_id, TemplateNode(template_id, combos)) for template_id, combos in template_combos.items())
             for t in self.tnodes.values():
                 t.trie = VariantTrie(limit=MAX_CARDS_IN_COMBO)
-                t.trie.add([], [t.template.id])
-            self.fnodes = dict[int, FeatureNode]()
-            for feature in data.features:
-                node = FeatureNode(feature,
-                    cards=[self.cnodes[i.id] for i in feature.cards.all()],
-                    produced_by_combos=[],
-                    needed_by_combos=[])
-                self.fnodes[feature.id] = node
-                for card in feature.cards.all():
-                    self.cnodes[card.id].features.append(node)
-            self.bnodes = dict[int, ComboNode]()
-            for combo in data.combos:
-                node = ComboNode(combo,
-                    cards=[self.cnodes[i.id] for i in combo.uses.all()],
-                    templates=[self.tnodes[i.id] for i in combo.requires.all()],
-                    features_needed=[self.fnodes[i.id] for i in combo.needs.all()],
-                    features_produced=[self.fnodes[i.id] for i in combo.produces.all()])
-                self.bnodes[combo.id] = node
-                for feature in combo.produces.all():
-                    featureNode = self.fnodes[feature.id]
-                    featureNode.produced_by_combos.append(node)
-                for feature in combo.needs.all():
-                    featureNode = self.fnodes[feature.id]
-                    featureNode.needed_by_combos.append(node)
-                for card in combo.uses.all():
-                    self.cnodes[card.id].combos.append(node)
-                for template in combo.requires.all():
-                    self.tnodes[template.id].combos.append(node)
+                t.trie.add([], [t.id])
+            self.fnodes = dict[int, FeatureNode]((feature_id, FeatureNode(feature_id,
+                cards=cards,
+                produced_by_combos=feature_produced_by[feature_id],
+                needed_by_combos=feature_needed_by[feature_id])) for feature_id, cards in feature_cards.items())
         else:
             raise Exception('Invalid arguments')
 
+    def __getstate__(self):
+        # The cache memoizes results by object identity, which is not preserved by pickling
+        state = self.__dict__.copy()
+        del state['cache']
+        del state['statistics']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = TrieCache()
+        self.statistics = TrieStatistics()
+
     def reset(self):
-        for node in self.cnodes.values():
-            node.state = NodeState.NOT_VISITED
-        for node in self.tnodes.values():
-            node.state = NodeState.NOT_VISITED
-        for node in self.fnodes.values():
-            node.state = NodeState.NOT_VISITED
-        for node in self.bnodes.values():
-            node.state = NodeState.NOT_VISITED
+        # Every node stamped with an older epoch is considered not visited
+        self.epoch += 1
+
+    def _state(self, node: Node) -> NodeState:
+        return node.state if node.epoch == self.epoch else NodeState.NOT_VISITED
+
+    def _set_state(self, node: Node, state: NodeState):
+        node.state = state
+        node.epoch = self.epoch
 
     def variants(self, combo_id: int) -> Iterable[VariantIngredients]:
+        for cards, templates in self.down(combo_id).variants():
+            yield self.up(cards, templates)
+
+    def down(self, combo_id: int) -> VariantTrie:
+        # Raises BudgetExceeded if the trie of the combo cannot be computed within the budget
         combo = self.bnodes[combo_id]
+        if combo in self.over_budget:
+            raise BudgetExceeded(self.over_budget[combo])
         # Reset step
         self.reset()
+        if self.budget is not None:
+            self.budget.start()
         # Down step
-        trie = self._combo_nodes_down(combo)
+        try:
+            return self._combo_nodes_down(combo)
+        except BudgetExceeded as e:
+            raise BudgetExceeded(f'{combo} {e}') from e
+
+    def up(self, cards: list[int], templates: list[int]) -> VariantIngredients:
         # Up step
-        for cards, templates in trie.variants():
-            self.reset()
-            yield self._card_nodes_up([self.cnodes[i] for i in cards], [self.tnodes[i] for i in templates])
+        return self._card_nodes_up([self.cnodes[i] for i in cards], [self.tnodes[i] for i in templates])
+
+    def dependent_combos(self, card_ids: Iterable[int], template_ids: Iterable[int], feature_ids: Iterable[int], combo_ids: Iterable[int]) -> set[int]:
+        # Combos whose down step can be affected by a change to the given nodes,
+        # found by following the graph from each node to the combos and features that use it
+        combos = set[int]()
+        features = set[int]()
+        combos_to_visit = list(combo_ids)
+        features_to_visit = list(feature_ids)
+        for card in (self.cnodes[c] for c in card_ids if c in self.cnodes):
+            combos_to_visit.extend(card.combos)
+            features_to_visit.extend(card.features)
+        for template in (self.tnodes[t] for t in template_ids if t in self.tnodes):
+            combos_to_visit.extend(template.combos)
+        while combos_to_visit or features_to_visit:
+            while features_to_visit:
+                feature_id = features_to_visit.pop()
+                if feature_id not in features and feature_id in self.fnodes:
+                    features.add(feature_id)
+                    combos_to_visit.extend(self.fnodes[feature_id].needed_by_combos)
+            if combos_to_visit:
+                combo_id = combos_to_visit.pop()
+                if combo_id not in combos and combo_id in self.bnodes:
+                    combos.add(combo_id)
+                    features_to_visit.extend(self.bnodes[combo_id].features_produced)
+        return combos
+
+    def precompute_tries(self, combo_ids: Optional[Iterable[int]] = None):
+        # Computes the tries of all features and combos bottom-up, one strongly connected component at a time.
+        # Components are evaluated after the ones they depend on, and cyclic ones up to a fixpoint.
+        # Given some combos, only the components they depend on are computed.
+        # The budget applies to each component, and the nodes depending on one over budget are over budget too.
+        for component in self._strongly_connected_components(combo_ids):
+            reason = next((self.over_budget[d] for node in component for d in self._dependencies(node) if d in self.over_budget), None)
+            if reason is None:
+                try:
+                    self._evaluate_component(component)
+                    continue
+                except BudgetExceeded as e:
+                    reason = f'{component[0]} {e}'
+            for node in component:
+                node.trie = None
+                self.over_budget[node] = reason
+
+    def _evaluate_component(self, component: list[Node]):
+        if self.budget is not None:
+            self.budget.start()
+        if len(component) == 1:
+            # A combo never depends directly on itself, nor a feature
+            component[0].trie = self._evaluate_trie(component[0])
+            return
+        # Semi-naive evaluation: tries only gain keys until the fixpoint, and both AND and OR distribute over the union,
+        # so the keys gained by a node only need to be combined with the current tries of the other operands of its dependents.
+        # Keys are propagated by increasing length: a key is never shorter than the keys it is made of,
+        # so every propagated key is final and no work is spent on keys later replaced by smaller ones.
+        # The tries of the component are modified in place until then, so they are kept out of the cache.
+        members = set(component)
+        dependents = dict[Node, list[Node]]((node, []) for node in component)
+        for node in component:
+            node.trie = VariantTrie(limit=MAX_CARDS_IN_COMBO)
+            for dependency in self._dependencies(node):
+                if dependency in members:
+                    dependents[dependency].append(node)
+        # The keys gained by each node and not propagated yet, by length
+        gained = [dict[Node, set[frozenset[int]]]() for _ in range(MAX_CARDS_IN_COMBO + 1)]
+
+        def merge(node: Node, keys: Iterable[frozenset[int]]):
+            size = len(node.trie)
+            for key in keys:
+                if key not in node.trie.index.keys:
+                    node.trie._add(key)
+                    if key in node.trie.index.keys:
+                        gained[len(key)].setdefault(node, set()).add(key)
+            if self.budget is not None and len(node.trie) != size:
+                self.budget.check(node.trie)
+        for node in component:
+            # Combos in a cycle need a feature of the cycle, so only features have keys from outside of it to start from
+            if isinstance(node, FeatureNode):
+                outside_tries = [self.cnodes[c].trie for c in node.cards] + [d.trie for d in self._dependencies(node) if d not in members and d.trie is not None]
+                merge(node, chain.from_iterable(t.index.keys for t in outside_tries))
+        while (keys_by_node := next((keys_by_node for keys_by_node in gained if keys_by_node), None)) is not None:
+            node = next(iter(keys_by_node))
+            keys = keys_by_node.pop(node)
+            delta = VariantTrie._from_candidates(keys, limit=MAX_CARDS_IN_COMBO)
+            for dependent in dependents[node]:
+                if isinstance(dependent, FeatureNode):
+                    merge(dependent, delta.index.keys)
+                else:
+                    operands = [self.cnodes[c].trie for c in dependent.cards] \
+                        + [self.tnodes[t].trie for t in dependent.templates] \
+                        + [f.trie if f.trie is not None else VariantTrie(limit=MAX_CARDS_IN_COMBO) for f in self._dependencies(dependent) if f is not node] \
+                        + [delta]
+                    merge(dependent, and_tries(operands, limit=MAX_CARDS_IN_COMBO, statistics=self.statistics, budget=self.budget).index.keys)
+
+    def _dependencies(self, node: Node) -> Iterable[Node]:
+        if isinstance(node, ComboNode):
+            return map(self.fnodes.__getitem__, node.features_needed)
+        return map(self.bnodes.__getitem__, node.produced_by_combos)
+
+    def _evaluate_trie(self, node: Node) -> VariantTrie:
+        # Combines the current tries of the dependencies of a node, missing ones counting as empty
+        dependencies_tries = [d.trie if d.trie is not None else VariantTrie(limit=MAX_CARDS_IN_COMBO) for d in self._dependencies(node)]
+        if isinstance(node, ComboNode):
+            card_tries = [self.cnodes[c].trie for c in node.cards]
+            template_tries = [self.tnodes[t].trie for t in node.templates]
+            return and_tries(card_tries + template_tries + dependencies_tries, limit=MAX_CARDS_IN_COMBO, statistics=self.statistics, cache=self.cache, budget=self.budget)
+        card_tries = [self.cnodes[c].trie for c in node.cards]
+        return or_tries(card_tries + dependencies_tries, limit=MAX_CARDS_IN_COMBO, statistics=self.statistics, cache=self.cache, budget=self.budget)
+
+    def _strongly_connected_components(self, combo_ids: Optional[Iterable[int]] = None) -> list[list[Node]]:
+        # Iterative Tarjan's algorithm over the feature and combo dependencies,
+        # yielding each component after all the components it depends on
+        index = dict[Node, int]()
+        lowlink = dict[Node, int]()
+        stack = list[Node]()
+        on_stack = set[Node]()
+        components = list[list[Node]]()
+        roots = chain(self.fnodes.values(), self.bnodes.values()) if combo_ids is None else map(self.bnodes.__getitem__, combo_ids)
+        for root in roots:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self._dependencies(root)))]
+            while work:
+                node, dependencies = work[-1]
+                for dependency in dependencies:
+                    if dependency not in index:
+                        index[dependency] = lowlink[dependency] = len(index)
+                        stack.append(dependency)
+                        on_stack.add(dependency)
+                        work.append((dependency, iter(self._dependencies(dependency))))
+                        break
+                    if dependency in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dependency])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = list[Node]()
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+                            if member is node:
+                                break
+                        components.append(component)
+        return components
 
     def _combo_nodes_down(self, combo: ComboNode) -> VariantTrie:
+        if self.trace is not None and self.trace.current() is not combo:
+            return self.trace.visit(combo, self._combo_nodes_down)
         if combo.trie is not None:
-            combo.state = NodeState.VISITED
+            self._set_state(combo, NodeState.VISITED)
             return combo.trie
-        combo.state = NodeState.VISITING
-        card_tries = [c.trie for c in combo.cards]
-        template_tries = [t.trie for t in combo.templates]
+        self._set_state(combo, NodeState.VISITING)
+        card_tries = [self.cnodes[c].trie for c in combo.cards]
+        template_tries = [self.tnodes[t].trie for t in combo.templates]
         needed_features_tries: list[VariantTrie] = []
         for f in combo.features_needed:
-            if f.state == NodeState.VISITING:
-                return VariantTrie()
-            needed_features_tries.append(self._feature_nodes_down(f))
-        combo.trie = and_tries(card_tries + template_tries + needed_features_tries, limit=MAX_CARDS_IN_COMBO)
-        combo.state = NodeState.VISITED
+            feature = self.fnodes[f]
+            if self._state(feature) == NodeState.VISITING:
+                return VariantTrie(limit=MAX_CARDS_IN_COMBO)
+            needed_features_tries.append(self._feature_nodes_down(feature))
+        combo.trie = and_tries(card_tries + template_tries + needed_features_tries, limit=MAX_CARDS_IN_COMBO, statistics=self.statistics, cache=self.cache, budget=self.budget)
+        self._set_state(combo, NodeState.VISITED)
         return combo.trie
 
     def _feature_nodes_down(self, feature: FeatureNode) -> VariantTrie:
+        if self.trace is not None and self.trace.current() is not feature:
+            return self.trace.visit(feature, self._feature_nodes_down)
         if feature.trie is not None:
-            feature.state = NodeState.VISITED
+            self._set_state(feature, NodeState.VISITED)
             return feature.trie
-        feature.state = NodeState.VISITING
-        card_tries = [c.trie for c in feature.cards]
+        self._set_state(feature, NodeState.VISITING)
+        card_tries = [self.cnodes[c].trie for c in feature.cards]
         produced_combos_tries: list[VariantTrie] = []
         for c in feature.produced_by_combos:
-            if c.state == NodeState.VISITING:
+            combo = self.bnodes[c]
+            if self._state(combo) == NodeState.VISITING:
                 continue
-            produced_combos_tries.append(self._combo_nodes_down(c))
-        feature.trie = or_tries(card_tries + produced_combos_tries, limit=MAX_CARDS_IN_COMBO)
-        feature.state = NodeState.VISITED
+            produced_combos_tries.append(self._combo_nodes_down(combo))
+        feature.trie = or_tries(card_tries + produced_combos_tries, limit=MAX_CARDS_IN_COMBO, statistics=self.statistics, cache=self.cache, budget=self.budget)
+        self._set_state(feature, NodeState.VISITED)
         return feature.trie
 
     def _card_nodes_up(self, cards: list[CardNode], templates: list[TemplateNode]) -> VariantIngredients:
-        for featrue_node in templates + cards:
-            featrue_node.state = NodeState.VISITED
-        card_nodes = set(cards)
-        template_nodes = set(templates)
-        feature_nodes: set[FeatureNode] = set()
-        combo_nodes_to_visit: set[ComboNode] = set()
-        combo_nodes: set[ComboNode] = set()
+        # Forward chaining: each combo reached from a card or a feature counts its unmet cards and features
+        # and fires once they are all satisfied, if its templates are present, producing its features.
+        # Combos that use no card and need no feature are never reached.
+        missing_requirements = dict[int, int]()
+        ready_combos = list[int]()
+        template_ids = {template.id for template in templates}
+        feature_ids = set[int]()
+        combo_ids = list[int]()
+        features_to_visit = list[int]()
+
+        def satisfy(combo_ids_to_satisfy: Iterable[int]):
+            for combo_id in combo_ids_to_satisfy:
+                missing = missing_requirements.get(combo_id)
+                combo = self.bnodes[combo_id]
+                if missing is None:
+                    missing = len(combo.cards) + len(combo.features_needed)
+                missing -= 1
+                missing_requirements[combo_id] = missing
+                if missing == 0 and template_ids.issuperset(combo.templates):
+                    ready_combos.append(combo_id)
         for card in cards:
-            for combo in card.combos:
-                if combo.state == NodeState.NOT_VISITED:
-                    combo.state = NodeState.VISITING
-                    combo_nodes_to_visit.add(combo)
-            for feature in card.features:
-                if feature.state == NodeState.NOT_VISITED:
-                    feature.state = NodeState.VISITED
-                    feature_nodes.add(feature)
-                    for feature_combo in feature.needed_by_combos:
-                        if feature_combo.state == NodeState.NOT_VISITED:
-                            feature_combo.state = NodeState.VISITING
-                            combo_nodes_to_visit.add(feature_combo)
-        flag = True
-        while flag:
-            flag = False
-            for combo in combo_nodes_to_visit:
-                if all((c in card_nodes for c in combo.cards)) and all((t in template_nodes for t in combo.templates)) and all((f in feature_nodes for f in combo.features_needed)):
-                    combo.state = NodeState.VISITED
-                    combo_nodes.add(combo)
-                    combo_nodes_to_visit.remove(combo)
-                    for feature in combo.features_produced:
-                        if feature.state == NodeState.NOT_VISITED:
-                            feature.state = NodeState.VISITED
-                            feature_nodes.add(feature)
-                            for feature_combo in feature.needed_by_combos:
-                                if feature_combo.state == NodeState.NOT_VISITED:
-                                    feature_combo.state = NodeState.VISITING
-                                    combo_nodes_to_visit.add(feature_combo)
-                    flag = True
-                    break
+            satisfy(card.combos)
+            features_to_visit.extend(card.features)
+        while features_to_visit or ready_combos:
+            while features_to_visit:
+                feature_id = features_to_visit.pop()
+                if feature_id not in feature_ids:
+                    feature_ids.add(feature_id)
+                    satisfy(self.fnodes[feature_id].needed_by_combos)
+            if ready_combos:
+                combo_id = ready_combos.pop()
+                combo_ids.append(combo_id)
+                features_to_visit.extend(self.bnodes[combo_id].features_produced)
         return VariantIngredients(
-            cards=[cn.card for cn in card_nodes],
-            templates=[tn.template for tn in template_nodes],
-            features=[fn.feature for fn in feature_nodes],
-            combos=[cn.combo for cn in combo_nodes if cn.state == NodeState.VISITED])
+            cards=[cn.id for cn in cards],
+            templates=[tn.id for tn in templates],
+            features=list(feature_ids),
+            combos=combo_ids)
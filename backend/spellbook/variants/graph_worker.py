@@ -0,0 +1,44 @@
+from typing import Optional
+from .combo_graph import Graph, VariantIngredients
+from .variant_trie import BudgetExceeded
+
+# Runs inside the worker processes of the parallel generation.
+# Nothing here imports the Django models, so that workers can be spawned without setting up Django.
+
+graph: Optional[Graph] = None
+
+ComboVariants = list[tuple[list[int], list[int], Optional[VariantIngredients]]]
+# The variants of a combo, or the reason why it was skipped
+ComboResult = tuple[int, ComboVariants, Optional[str]]
+
+
+def initialize(shared_graph: Graph):
+    global graph
+    graph = shared_graph
+
+
+def combos_variants(combo_ids: list[int]) -> list[ComboResult]:
+    # The up step is only run for the first occurrence of each variant in the chunk,
+    # whose closure is enough for the merge to build its definition
+    result = list[ComboResult]()
+    seen = set[tuple[tuple[int, ...], tuple[int, ...]]]()
+    for combo_id in combo_ids:
+        variants = ComboVariants()
+        try:
+            trie = graph.down(combo_id)
+        except BudgetExceeded as e:
+            result.append((combo_id, variants, str(e)))
+            continue
+        for cards, templates in trie.variants():
+            key = (tuple(cards), tuple(templates))
+            if key in seen:
+                variants.append((cards, templates, None))
+            else:
+                seen.add(key)
+                variants.append((cards, templates, graph.up(cards, templates)))
+        result.append((combo_id, variants, None))
+    return result
+
+
+def closures(variants: list[tuple[list[int], list[int]]]) -> list[VariantIngredients]:
+    return [graph.up(cards, templates) for cards, templates in variants]
@@ -0,0 +1,118 @@
+import sys
+import time
+import heapq
+import threading
+import tracemalloc
+from typing import Iterable, Optional, TypeVar
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+T = TypeVar('T')
+SLOWEST_IN_SUMMARY = 10
+
+
+def peak_rss() -> Optional[int]:
+    # Peak resident set size of the process so far, in bytes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_bytes(size: Optional[int]) -> str:
+    return 'n/a' if size is None else f'{size / 2 ** 20:.1f} MiB'
+
+
+@dataclass
+class PhaseProfile:
+    calls: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    # Peaks reached by the end of the phase, traced memory only when tracemalloc is tracing
+    peak_rss: Optional[int] = None
+    peak_traced_memory: Optional[int] = None
+
+
+class Profiler:
+    # Accumulates wall time, CPU time and memory peaks of named phases, which can be entered
+    # any number of times from any thread, together with named counters and the time spent on single items.
+    # CPU time is the one of the thread that entered the phase.
+    def __init__(self):
+        self.phases = dict[str, PhaseProfile]()
+        self.counters = dict[str, int]()
+        self.durations = dict[str, dict[int, float]]()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.thread_time() - cpu_start
+            rss = peak_rss()
+            traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+            with self.lock:
+                profile = self.phases.setdefault(name, PhaseProfile())
+                profile.calls += 1
+                profile.wall_time += wall_time
+                profile.cpu_time += cpu_time
+                if rss is not None:
+                    profile.peak_rss = max(rss, profile.peak_rss or 0)
+                if traced is not None:
+                    profile.peak_traced_memory = max(traced, profile.peak_traced_memory or 0)
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterable[T]:
+        # Only the time spent producing the items counts towards the phase
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def maximum(self, name: str, value: int):
+        with self.lock:
+            self.counters[name] = max(value, self.counters.get(name, value))
+
+    def duration(self, category: str, key: int, seconds: float):
+        with self.lock:
+            durations = self.durations.setdefault(category, {})
+            durations[key] = durations.get(key, 0.0) + seconds
+
+    def slowest(self, category: str, count: int) -> list[tuple[int, float]]:
+        return heapq.nlargest(count, self.durations.get(category, {}).items(), key=lambda item: item[1])
+
+    def as_dict(self) -> dict:
+        return {
+            'phases': {name: asdict(profile) for name, profile in self.phases.items()},
+            'counters': dict(self.counters),
+            'slowest': {category: self.slowest(category, SLOWEST_IN_SUMMARY) for category in self.durations},
+        }
+
+    def summary(self) -> str:
+        lines = list[str]()
+        for name, profile in self.phases.items():
+            line = f'{name}: {profile.wall_time:.3f}s wall, {profile.cpu_time:.3f}s CPU'
+            if profile.calls > 1:
+                line += f' over {profile.calls} calls'
+            line += f', peak RSS {format_bytes(profile.peak_rss)}'
+            if profile.peak_traced_memory is not None:
+                line += f', peak traced {format_bytes(profile.peak_traced_memory)}'
+            lines.append(line)
+        lines.extend(f'{name}: {value}' for name, value in self.counters.items())
+        return '\n'.join(lines)
@@ -1,12 +1,161 @@
+import sys
+import hashlib
+from array import array
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+from django.db.models import Model
 from ..models import Card, Feature, Combo, Template, Variant
+from .variant_trie import SubsetIndex
+
+
+SNAPSHOT_MAGIC = b'CSBSNAP\0'
+SNAPSHOT_VERSION = 1
+# Every section is a flat array of 64 bit integers: ids, pairs of ids one after the other,
+# or, for the not working variants, each card set preceded by its length
+SNAPSHOT_SECTIONS = (
+    'card_ids',
+    'template_ids',
+    'feature_ids',
+    'combo_ids',
+    'generator_combo_ids',
+    'utility_features_ids',
+    'feature_cards',
+    'combo_cards',
+    'combo_templates',
+    'combo_needs',
+    'combo_produces',
+    'combo_removes',
+    'not_working_variants',
+)
+
+
+def ids(model: type[Model], **filters) -> tuple[int, ...]:
+    return tuple(model.objects.filter(**filters).values_list('id', flat=True))
+
+
+def relation_pairs(through: type[Model], source: str, target: str) -> tuple[tuple[int, int], ...]:
+    # Pairs follow the ordering of both models, like the related managers would
+    ordering = [f'{name}__{order}' for name in (source, target) for order in through._meta.get_field(name).related_model._meta.ordering]
+    return tuple(through.objects.order_by(*ordering, f'{target}_id').values_list(f'{source}_id', f'{target}_id'))
+
+
+def flatten_pairs(pairs: tuple[tuple[int, int], ...]) -> list[int]:
+    return [item for pair in pairs for item in pair]
+
+
+class PairsView:
+    # Pairs of ids read from a flat sequence of ids one after the other, without copying it
+    __slots__ = ('items',)
+
+    def __init__(self, items: Sequence[int]):
+        self.items = items
+
+    def __len__(self) -> int:
+        return len(self.items) // 2
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        return zip(self.items[0::2], self.items[1::2])
 
 
 class Data:
-    def __init__(self):
-        self.combos = Combo.objects.prefetch_related('uses', 'requires', 'needs', 'removes', 'produces')
-        self.features = Feature.objects.prefetch_related('cards', 'produced_by_combos', 'needed_by_combos', 'removed_by_combos')
-        self.cards = Card.objects.prefetch_related('features', 'used_in_combos')
-        self.variants = Variant.objects.prefetch_related('uses', 'requires')
-        self.utility_features_ids = frozenset[int](Feature.objects.filter(utility=True).values_list('id', flat=True))
-        self.templates = Template.objects.prefetch_related('required_by_combos')
-        self.not_working_variants = [frozenset[int](v.uses.values_list('id', flat=True)) for v in self.variants.filter(status=Variant.Status.NOT_WORKING)]
+    # Compact snapshot of the catalog, made only of ids and pairs of ids,
+    # loaded from the database or from a snapshot file
+    def __init__(self, snapshot: Optional[Path] = None):
+        self.not_working_variants = SubsetIndex()
+        if snapshot is not None:
+            self.load_snapshot(snapshot)
+            return
+        self.card_ids = ids(Card)
+        self.template_ids = ids(Template)
+        self.feature_ids = ids(Feature)
+        self.combo_ids = ids(Combo)
+        self.generator_combo_ids = ids(Combo, generator=True)
+        self.utility_features_ids = frozenset[int](ids(Feature, utility=True))
+        self.feature_cards = relation_pairs(Card.features.through, 'feature', 'card')
+        self.combo_cards = relation_pairs(Combo.uses.through, 'combo', 'card')
+        self.combo_templates = relation_pairs(Combo.requires.through, 'combo', 'template')
+        self.combo_needs = relation_pairs(Combo.needs.through, 'combo', 'feature')
+        self.combo_produces = relation_pairs(Combo.produces.through, 'combo', 'feature')
+        self.combo_removes = relation_pairs(Combo.removes.through, 'combo', 'feature')
+        not_working_cards = dict[int, set[int]]()
+        # A not working variant without cards still yields its id, with None as card
+        for variant_id, card_id in Variant.objects.filter(status=Variant.Status.NOT_WORKING).values_list('id', 'uses'):
+            cards = not_working_cards.setdefault(variant_id, set())
+            if card_id is not None:
+                cards.add(card_id)
+        for cards in not_working_cards.values():
+            self.not_working_variants.add(frozenset(cards))
+
+    def snapshot_sections(self) -> dict[str, list[int]]:
+        return {
+            'card_ids': self.card_ids,
+            'template_ids': self.template_ids,
+            'feature_ids': self.feature_ids,
+            'combo_ids': self.combo_ids,
+            'generator_combo_ids': self.generator_combo_ids,
+            'utility_features_ids': sorted(self.utility_features_ids),
+            'feature_cards': flatten_pairs(self.feature_cards),
+            'combo_cards': flatten_pairs(self.combo_cards),
+            'combo_templates': flatten_pairs(self.combo_templates),
+            'combo_needs': flatten_pairs(self.combo_needs),
+            'combo_produces': flatten_pairs(self.combo_produces),
+            'combo_removes': flatten_pairs(self.combo_removes),
+            'not_working_variants': [item for cards in sorted(sorted(cards) for cards in self.not_working_variants) for item in (len(cards), *cards)],
+        }
+
+    def fingerprint(self) -> str:
+        hash_algorithm = hashlib.sha256()
+        for name, items in self.snapshot_sections().items():
+            hash_algorithm.update(name.encode('utf-8'))
+            hash_algorithm.update(array('q', [len(items), *items]).tobytes())
+        return hash_algorithm.hexdigest()
+
+    def save_snapshot(self, path: Path):
+        sections = self.snapshot_sections()
+        header = array('q', [SNAPSHOT_VERSION, len(SNAPSHOT_SECTIONS), *(len(sections[name]) for name in SNAPSHOT_SECTIONS)])
+        body = array('q', (item for name in SNAPSHOT_SECTIONS for item in sections[name]))
+        if sys.byteorder != 'little':
+            header.byteswap()
+            body.byteswap()
+        with path.open('wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            header.tofile(f)
+            body.tofile(f)
+
+    def load_snapshot(self, path: Path):
+        # The file is read at once into a flat array of integers, and every section is a view of it:
+        # ids and pairs are only turned into Python integers while they are iterated
+        with path.open('rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise Exception(f'{path} is not a catalog snapshot')
+            items = array('q')
+            items.frombytes(f.read())
+        if sys.byteorder != 'little':
+            items.byteswap()
+        version, section_count = items[0], items[1]
+        if version != SNAPSHOT_VERSION or section_count != len(SNAPSHOT_SECTIONS):
+            raise Exception(f'Unsupported catalog snapshot version {version}, expected {SNAPSHOT_VERSION}')
+        view = memoryview(items)
+        sections = dict[str, memoryview]()
+        offset = 2 + section_count
+        for name, length in zip(SNAPSHOT_SECTIONS, items[2:offset]):
+            sections[name] = view[offset:offset + length]
+            offset += length
+        self.card_ids = sections['card_ids']
+        self.template_ids = sections['template_ids']
+        self.feature_ids = sections['feature_ids']
+        self.combo_ids = sections['combo_ids']
+        self.generator_combo_ids = sections['generator_combo_ids']
+        self.utility_features_ids = frozenset[int](sections['utility_features_ids'])
+        self.feature_cards = PairsView(sections['feature_cards'])
+        self.combo_cards = PairsView(sections['combo_cards'])
+        self.combo_templates = PairsView(sections['combo_templates'])
+        self.combo_needs = PairsView(sections['combo_needs'])
+        self.combo_produces = PairsView(sections['combo_produces'])
+        self.combo_removes = PairsView(sections['combo_removes'])
+        not_working_variants = sections['not_working_variants']
+        i = 0
+        while i < len(not_working_variants):
+            length = not_working_variants[i]
+            self.not_working_variants.add(frozenset(not_working_variants[i + 1:i + 1 + length]))
+            i += 1 + length
@@ -0,0 +1,45 @@
+from typing import Iterable
+from dataclasses import dataclass
+from django.db.models import QuerySet
+from ..models import Card, Combo, Variant
+
+
+TEXT_FIELDS = ('zone_locations', 'cards_state', 'other_prerequisites', 'mana_needed', 'description')
+
+
+@dataclass(frozen=True)
+class ComboText:
+    # The position of the combo in the combos ordering, which is the order of its text inside variants
+    rank: int
+    zone_locations: str
+    cards_state: str
+    other_prerequisites: str
+    mana_needed: str
+    description: str
+
+
+def load_combo_texts(combos: QuerySet = None) -> dict[int, ComboText]:
+    if combos is None:
+        combos = Combo.objects.all()
+    return {
+        combo_id: ComboText(rank, *texts)
+        for rank, (combo_id, *texts) in enumerate(combos.values_list('id', *TEXT_FIELDS))
+    }
+
+
+def load_card_identities() -> dict[int, str]:
+    return dict(Card.objects.values_list('id', 'identity'))
+
+
+def merge_identities(identities: Iterable[str]):
+    i = set(''.join(identities).upper())
+    return ''.join([color for color in 'WUBRG' if color in i])
+
+
+def assemble_variant_text(variant: Variant, combo_ids: Iterable[int], combo_texts: dict[int, ComboText]):
+    combos = sorted((combo_texts[combo_id] for combo_id in combo_ids), key=lambda c: c.rank)
+    variant.zone_locations = '\n'.join(c.zone_locations for c in combos if len(c.zone_locations) > 0)
+    variant.cards_state = '\n'.join(c.cards_state for c in combos if len(c.cards_state) > 0)
+    variant.other_prerequisites = '\n'.join(c.other_prerequisites for c in combos if len(c.other_prerequisites) > 0)
+    variant.mana_needed = ' '.join(c.mana_needed for c in combos if len(c.mana_needed) > 0)
+    variant.description = '\n'.join(c.description for c in combos if len(c.description) > 0)
@@ -1,106 +1,420 @@
-from pygtrie import Trie
-from itertools import product
+import time
+import weakref
+from itertools import product, combinations, islice
+from math import comb
+from enum import Enum
+from typing import Callable, Iterable, Optional
+from dataclasses import dataclass
+from collections import OrderedDict
 
 cardid = int
 templateid = int
+ingredientid = int
 
 
 DEFAULT_MAX_DEPTH = 100
+DEFAULT_CACHE_KEYS = 1000000
+DEADLINE_CHECK_INTERVAL = 10000
 
 
-def rotate(li: list, x: int) -> list:
-    return li[-x % len(li):] + li[:-x % len(li)]
+def card_ingredient(card_id: cardid) -> ingredientid:
+    return card_id
 
 
-def all_rotations(li: list) -> list[list]:
-    return [rotate(li, x) for x in range(len(li))]
+def template_ingredient(template_id: templateid) -> ingredientid:
+    return -template_id
 
 
-def merge_sort(left: list, right: list) -> list:
-    return sorted(set(left + right))
+class SubsetIndex():
+    # Inverted index from every item to the stored sets containing it,
+    # answering subset and superset queries without scanning all the stored sets.
+    def __init__(self):
+        self.keys = set[frozenset[int]]()
+        self.keys_by_item = dict[int, set[frozenset[int]]]()
+        self.count_by_length = dict[int, int]()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def add(self, key: frozenset[int]):
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        self.count_by_length[len(key)] = self.count_by_length.get(len(key), 0) + 1
+        for item in key:
+            self.keys_by_item.setdefault(item, set()).add(key)
+
+    def remove(self, key: frozenset[int]):
+        self.keys.remove(key)
+        self.count_by_length[len(key)] -= 1
+        if self.count_by_length[len(key)] == 0:
+            del self.count_by_length[len(key)]
+        for item in key:
+            keys = self.keys_by_item[item]
+            keys.remove(key)
+            if not keys:
+                del self.keys_by_item[item]
+
+    def contains_subset_of(self, key: frozenset[int]) -> bool:
+        if frozenset() in self.keys:
+            return True
+        postings = [self.keys_by_item.get(item, ()) for item in key]
+        lengths = [length for length in self.count_by_length if length <= len(key)]
+        if sum(len(posting) for posting in postings) > sum(comb(len(key), length) for length in lengths):
+            # Small keys against a dense index: looking up every subset of key is cheaper
+            return any(frozenset(subset) in self.keys for length in lengths for subset in combinations(key, length))
+        # A stored set is a subset of key when all of its items have been counted
+        counts = dict[frozenset[int], int]()
+        for posting in postings:
+            for stored_key in posting:
+                count = counts.get(stored_key, 0) + 1
+                if count == len(stored_key):
+                    return True
+                counts[stored_key] = count
+        return False
+
+    def supersets_of(self, key: frozenset[int]) -> set[frozenset[int]]:
+        if not key:
+            return set(self.keys)
+        postings = sorted((self.keys_by_item.get(item, set()) for item in key), key=len)
+        return postings[0].intersection(*postings[1:])
 
 
 class VariantTrie():
+    # Stores a family of minimal ingredient sets: no stored key is a subset of another one.
+    # Every key is a frozenset of ingredient ids, where cards are encoded as their positive id
+    # and templates as their negated id.
     def __init__(self, limit: int = DEFAULT_MAX_DEPTH):
-        self.trie = Trie()
+        self.index = SubsetIndex()
         self.max_depth = limit
+        self._content: Optional[frozenset[frozenset[ingredientid]]] = None
 
-    def ingredients_to_key(self, cards: list[cardid], templates: list[templateid]) -> list[str]:
-        return merge_sort([f'C{c_id}' for c_id in cards], [f'T{t_id}' for t_id in templates])
+    def ingredients_to_key(self, cards: list[cardid], templates: list[templateid]) -> frozenset[ingredientid]:
+        return frozenset([card_ingredient(c_id) for c_id in cards] + [template_ingredient(t_id) for t_id in templates])
 
     def add(self, cards: list[cardid], templates: list[templateid]):
-        base_key = self.ingredients_to_key(cards, templates)
-        if len(base_key) > self.max_depth:
-            return
-        keys = all_rotations(base_key)
-        self._add(base_key, keys)
+        self._add(self.ingredients_to_key(cards, templates))
 
-    def _add(self, key: list[str], all_rotations: list[list[str]]):
+    def _add(self, key: frozenset[ingredientid]):
         if len(key) > self.max_depth:
             return
-        for key in all_rotations:
-            prefix = self.trie.longest_prefix(key)
-            if prefix and self.trie.has_key(prefix.key):
-                return
-        for key in all_rotations:
-            if self.trie.has_subtrie(key):
-                for subkey in self.trie.keys(prefix=key):
-                    for rotated_subkey in self.trie[subkey]:
-                        del self.trie[rotated_subkey]
-            self.trie[key] = all_rotations
+        if self.index.contains_subset_of(key):
+            return
+        for stored_key in self.index.supersets_of(key):
+            self.index.remove(stored_key)
+        self.index.add(key)
+        self._content = None
 
-    def __or__(self, other: 'VariantTrie') -> 'VariantTrie':
-        result = VariantTrie(limit=self.max_depth)
-        for key, value in self.trie.items() + other.trie.items():
-            result._add(key, value)
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def content(self) -> frozenset[frozenset[ingredientid]]:
+        # Built once per trie, since tries are no longer modified once shared, and frozen sets cache their hash
+        if self._content is None:
+            self._content = frozenset(self.index.keys)
+        return self._content
+
+    def min_key_length(self) -> int:
+        return min(self.index.count_by_length, default=0)
+
+    def _keys_by_length(self) -> dict[int, list[frozenset[ingredientid]]]:
+        result = dict[int, list[frozenset[ingredientid]]]()
+        for key in self.index:
+            result.setdefault(len(key), []).append(key)
+        return result
+
+    @classmethod
+    def _from_candidates(cls, candidates: set[frozenset[ingredientid]], limit: int) -> 'VariantTrie':
+        # Inserting by increasing size means a key can never be a superset of a later one,
+        # so only the subset check is needed
+        result = cls(limit=limit)
+        for key in sorted(candidates, key=len):
+            if len(key) > limit:
+                break
+            if not result.index.contains_subset_of(key):
+                result.index.add(key)
         return result
 
+    def __or__(self, other: 'VariantTrie') -> 'VariantTrie':
+        return VariantTrie._from_candidates(self.index.keys | other.index.keys, limit=self.max_depth)
+
     def __add__(self, other: 'VariantTrie') -> 'VariantTrie':
         return self.__or__(other)
 
     def __and__(self, other: 'VariantTrie') -> 'VariantTrie':
-        result = VariantTrie(limit=self.max_depth)
-        for left_part, right_part in product(self.trie.keys(), other.trie.keys()):
-            key = merge_sort(left_part, right_part)
-            if len(key) > self.max_depth:
+        return self._and(other, limit=self.max_depth)
+
+    def _and(self, other: 'VariantTrie', limit: int, budget: Optional['Budget'] = None) -> 'VariantTrie':
+        candidates = set[frozenset[ingredientid]]()
+        right_groups = other._keys_by_length()
+        for left_length, left_group in self._keys_by_length().items():
+            overlapping_groups = list[list[frozenset[ingredientid]]]()
+            for right_length, right_group in right_groups.items():
+                if left_length + right_length > limit:
+                    overlapping_groups.append(right_group)
+                    continue
+                # Every union fits within the limit, no need to check them one by one
+                for pairs in _deadline_checked(product(left_group, right_group), budget):
+                    candidates.update(left_part | right_part for left_part, right_part in pairs)
+            if not overlapping_groups:
                 continue
-            result._add(key, all_rotations(key))
-        return result
+            # Disjoint pairs are too big: only the right keys sharing an item with a left key can fit.
+            # They are found through the inverted index, unless scanning all of them is cheaper.
+            overlapping_count = sum(len(group) for group in overlapping_groups)
+            overlapping_lengths = {len(group[0]) for group in overlapping_groups}
+            for left_parts in _deadline_checked(iter(left_group), budget, interval=max(1, DEADLINE_CHECK_INTERVAL // overlapping_count)):
+                for left_part in left_parts:
+                    postings = [other.index.keys_by_item.get(item, ()) for item in left_part]
+                    if sum(len(posting) for posting in postings) < overlapping_count:
+                        right_parts = (right_part for right_part in set[frozenset[ingredientid]]().union(*postings) if len(right_part) in overlapping_lengths)
+                    else:
+                        right_parts = (right_part for group in overlapping_groups for right_part in group if not left_part.isdisjoint(right_part))
+                    for right_part in right_parts:
+                        key = left_part | right_part
+                        if len(key) <= limit:
+                            candidates.add(key)
+        return VariantTrie._from_candidates(candidates, limit=limit)
 
     def __mul__(self, other: 'VariantTrie') -> 'VariantTrie':
         return self.__and__(other)
 
     def variants(self) -> list[tuple[list[cardid], list[templateid]]]:
         result = list[tuple[list[cardid], list[templateid]]]()
-        for key in self.trie.keys():
-            cards = list[cardid]()
-            templates = list[templateid]()
-            for item in key:
-                if item[0] == 'C':
-                    cards.append(int(item[1:]))
-                elif item[0] == 'T':
-                    templates.append(int(item[1:]))
+        for key in sorted(sorted(key) for key in self.index):
+            cards = [item for item in key if item > 0]
+            templates = [-item for item in reversed(key) if item < 0]
             result.append((cards, templates))
         return result
 
     def __str__(self):
-        return str(self.trie)
+        return str(self.variants())
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    # Limits the work of a single unit, like the down step of a combo: the size of the tries it computes,
+    # the pairs of keys combined by its AND aggregations and its wall time. None means no limit.
+    def __init__(self, max_trie_size: Optional[int] = None, max_and_pairs: Optional[int] = None, max_seconds: Optional[float] = None):
+        self.max_trie_size = max_trie_size
+        self.max_and_pairs = max_and_pairs
+        self.max_seconds = max_seconds
+        self.start()
+
+    def start(self):
+        self.and_pairs = 0
+        self.deadline = time.perf_counter() + self.max_seconds if self.max_seconds is not None else None
+
+    def spend_and_pairs(self, pairs: int):
+        # Called before combining the pairs, so that an exploding AND is never started
+        self.and_pairs += pairs
+        if self.max_and_pairs is not None and self.and_pairs > self.max_and_pairs:
+            raise BudgetExceeded(f'needed more than {self.max_and_pairs} AND pairs')
+
+    def check(self, trie: VariantTrie):
+        if self.max_trie_size is not None and len(trie) > self.max_trie_size:
+            raise BudgetExceeded(f'built a trie of more than {self.max_trie_size} keys')
+        self.check_deadline()
+
+    def check_deadline(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceeded(f'took more than {self.max_seconds} seconds')
+
+
+def _deadline_checked(items: Iterable, budget: Optional[Budget], interval: int = DEADLINE_CHECK_INTERVAL) -> Iterable[Iterable]:
+    # Splits the pairs or keys of a single AND into batches, checking the deadline before each of them,
+    # so that one exploding AND cannot overrun the time budget
+    if budget is None or budget.deadline is None:
+        yield items
+        return
+    while batch := tuple(islice(items, interval)):
+        budget.check_deadline()
+        yield batch
+
+
+class Aggregation(Enum):
+    AND = 'and'
+    OR = 'or'
+
+
+@dataclass(frozen=True)
+class AggregationRecord:
+    strategy: Aggregation
+    operand_sizes: tuple[int, ...]
+    intermediate_sizes: tuple[int, ...]
+    result_size: int
+    short_circuited: bool
+    # Pairs of keys combined by the AND steps that were not memoized
+    pairs: int = 0
+    # Steps served from the memo, and the pairs they combined when they were first computed
+    memo_hits: int = 0
+    memoized_pairs: int = 0
+
+
+class TrieStatistics:
+    def __init__(self):
+        self.records = list[AggregationRecord]()
+
+    def record(self, record: AggregationRecord):
+        self.records.append(record)
+
+    def summary(self) -> str:
+        lines = list[str]()
+        for strategy in Aggregation:
+            records = [r for r in self.records if r.strategy == strategy]
+            if not records:
+                continue
+            operands = [size for r in records for size in r.operand_sizes]
+            intermediates = [size for r in records for size in r.intermediate_sizes]
+            lines.append(
+                f'{strategy.name}: {len(records)} calls, '
+                f'{sum(r.short_circuited for r in records)} short-circuited, '
+                f'{len(operands)} operands (largest {max(operands, default=0)}), '
+                f'largest intermediate {max(intermediates, default=0)}, '
+                f'largest result {max(r.result_size for r in records)}, '
+                f'{sum(r.pairs for r in records)} pairs combined, '
+                f'{sum(r.memo_hits for r in records)} steps memoized')
+        return '\n'.join(lines)
+
+
+class TrieCache:
+    # Interns tries by content, so that equal tries are the same object,
+    # and memoizes aggregation results keyed by the identity of their interned operands.
+    # Interned tries are shared and must not be modified.
+    # The interning table holds tries weakly: a trie stays interned while the graph or a memo entry uses it.
+    # Memo entries keep their operands alive, so that their ids cannot be reused by other tries.
+    # The memo is bounded by the total number of keys of the tries its entries keep alive.
+    def __init__(self, max_keys: int = DEFAULT_CACHE_KEYS):
+        self.max_keys = max_keys
+        self.keys = 0
+        self.interned = weakref.WeakValueDictionary[tuple[frozenset[frozenset[ingredientid]], int], VariantTrie]()
+        self.memo = OrderedDict[tuple, tuple[VariantTrie, tuple[VariantTrie, ...], int]]()
+        self.intern_hits = 0
+        self.intern_misses = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def intern(self, trie: VariantTrie) -> VariantTrie:
+        key = (trie.content(), trie.max_depth)
+        interned = self.interned.get(key)
+        if interned is None:
+            self.intern_misses += 1
+            self.interned[key] = trie
+            return trie
+        self.intern_hits += 1
+        return interned
+
+    def memoized(self, key: tuple, operands: tuple[VariantTrie, ...], compute: Callable[[], tuple[VariantTrie, int]]) -> tuple[VariantTrie, int, bool]:
+        # compute returns the result with the pairs it combined, which are returned again on hits,
+        # along with whether the result came from the memo
+        entry = self.memo.get(key)
+        if entry is not None:
+            self.memo_hits += 1
+            self.memo.move_to_end(key)
+            return entry[0], entry[2], True
+        self.memo_misses += 1
+        result, pairs = compute()
+        result = self.intern(result)
+        self.memo[key] = (result, operands, pairs)
+        self.keys += self._entry_keys(result, operands)
+        while self.keys > self.max_keys and self.memo:
+            _, (evicted_result, evicted_operands, _) = self.memo.popitem(last=False)
+            self.keys -= self._entry_keys(evicted_result, evicted_operands)
+        return result, pairs, False
+
+    @staticmethod
+    def _entry_keys(result: VariantTrie, operands: tuple[VariantTrie, ...]) -> int:
+        return len(result) + sum(len(operand) for operand in operands)
+
+    def summary(self) -> str:
+        def rate(hits: int, misses: int) -> str:
+            return f'{hits}/{hits + misses} hits ({hits / (hits + misses) if hits + misses else 0:.1%})'
+        return f'interning: {rate(self.intern_hits, self.intern_misses)}, {len(self.interned)} distinct tries alive\n' \
+            f'memo: {rate(self.memo_hits, self.memo_misses)}, {len(self.memo)} entries holding {self.keys} keys'
+
+
+def or_tries(tries: list[VariantTrie], limit: int = DEFAULT_MAX_DEPTH, statistics: Optional[TrieStatistics] = None, cache: Optional[TrieCache] = None, budget: Optional[Budget] = None) -> VariantTrie:
+    return aggregate_tries(tries, limit=limit, strategy=Aggregation.OR, statistics=statistics, cache=cache, budget=budget)
+
 
+def and_tries(tries: list[VariantTrie], limit: int = DEFAULT_MAX_DEPTH, statistics: Optional[TrieStatistics] = None, cache: Optional[TrieCache] = None, budget: Optional[Budget] = None) -> VariantTrie:
+    return aggregate_tries(tries, limit=limit, strategy=Aggregation.AND, statistics=statistics, cache=cache, budget=budget)
 
-def or_tries(tries: list[VariantTrie], limit: int = DEFAULT_MAX_DEPTH) -> VariantTrie:
-    return aggregate_tries(tries, limit=limit, strategy=lambda x, y: x | y)
 
+def _or_all(tries: list[VariantTrie], limit: int) -> VariantTrie:
+    return VariantTrie._from_candidates(set[frozenset[ingredientid]]().union(*(t.index.keys for t in tries)), limit=limit)
 
-def and_tries(tries: list[VariantTrie], limit: int = DEFAULT_MAX_DEPTH) -> VariantTrie:
-    return aggregate_tries(tries, limit=limit, strategy=lambda x, y: x & y)
 
+def aggregate_tries(tries: list[VariantTrie], strategy: Aggregation, limit: int = DEFAULT_MAX_DEPTH, statistics: Optional[TrieStatistics] = None, cache: Optional[TrieCache] = None, budget: Optional[Budget] = None) -> VariantTrie:
+    if cache is not None:
+        tries = [cache.intern(t) for t in tries]
+    intermediate_sizes = list[int]()
+    short_circuited = False
+    pairs = 0
+    memo_hits = 0
+    memoized_pairs = 0
 
-def aggregate_tries(tries: list[VariantTrie], strategy, limit: int = DEFAULT_MAX_DEPTH) -> VariantTrie:
-    match len(tries):
-        case 0: return VariantTrie(limit=limit)
-        case 1: return tries[0]
-        case _:
+    def and_pair(left: VariantTrie, right: VariantTrie) -> tuple[VariantTrie, int]:
+        if budget is not None:
+            budget.spend_and_pairs(len(left) * len(right))
+        return left._and(right, limit=limit, budget=budget), len(left) * len(right)
+    match len(tries), strategy:
+        case 0, _:
+            plan = tries
+            result = VariantTrie(limit=limit)
+        case 1, _:
+            plan = tries
             result = tries[0]
-            for trie in tries[1:]:
-                result = strategy(result, trie)
-            return result
+        case _, Aggregation.OR:
+            # The union of all operands is minimized at once, so the order does not matter
+            plan = tries
+            if cache is not None:
+                result, _, hit = cache.memoized((strategy, limit, frozenset(id(t) for t in tries)), tuple(tries), lambda: (_or_all(tries, limit=limit), 0))
+                memo_hits += hit
+            else:
+                result = _or_all(tries, limit=limit)
+            if budget is not None:
+                budget.check(result)
+        case _, Aggregation.AND:
+            # Folding the smallest operands first keeps intermediate results small
+            plan = sorted(tries, key=lambda t: (len(t), t.min_key_length()))
+            if len(plan[0]) == 0 or max(t.min_key_length() for t in plan) > limit:
+                # No key can be produced within the limit
+                short_circuited = True
+                result = VariantTrie(limit=limit)
+            else:
+                result = plan[0]
+                for trie in plan[1:]:
+                    if cache is not None:
+                        left = result
+                        result, step_pairs, hit = cache.memoized((strategy, limit, frozenset((id(left), id(trie)))), (left, trie), lambda: and_pair(left, trie))
+                    else:
+                        result, step_pairs = and_pair(result, trie)
+                        hit = False
+                    if hit:
+                        memo_hits += 1
+                        memoized_pairs += step_pairs
+                    else:
+                        pairs += step_pairs
+                    intermediate_sizes.append(len(result))
+                    if budget is not None:
+                        budget.check(result)
+                    if len(result) == 0:
+                        short_circuited = True
+                        break
+    if statistics is not None:
+        statistics.record(AggregationRecord(
+            strategy=strategy,
+            operand_sizes=tuple(len(t) for t in plan),
+            intermediate_sizes=tuple(intermediate_sizes),
+            result_size=len(result),
+            short_circuited=short_circuited,
+            pairs=pairs,
+            memo_hits=memo_hits,
+            memoized_pairs=memoized_pairs))
+    return result
@@ -1,12 +1,38 @@
+import os
+import re
 import json
+import time
+import math
 import hashlib
+import socket
 import logging
-from typing import Iterable
+import threading
+from queue import Queue, Full
+from collections import deque
+from contextlib import nullcontext
+from typing import Iterable, Optional
+from datetime import datetime, timedelta
+from pathlib import Path
 from dataclasses import dataclass
-from django.db import transaction
-from ..models import Job, Variant
+from concurrent.futures import Future, ProcessPoolExecutor
+from django.conf import settings
+from django.db import transaction, connection, connections
+from django.utils import timezone
+from ..models import Job, GenerationShard, Variant, Card, Template, Feature, Combo
+from ..utils import JobProgress
 from .variant_data import Data
-from .combo_graph import Graph
+from .profiler import Profiler
+from .combo_graph import Graph, DownTrace, VariantIngredients, group_pairs
+from .variant_trie import Budget, BudgetExceeded
+from .variant_text import TEXT_FIELDS, ComboText, load_combo_texts, load_card_identities, merge_identities, assemble_variant_text
+from . import graph_worker
+
+
+BULK_BATCH_SIZE = 1000
+STREAM_QUEUE_SIZE = 8
+CHECKPOINT_VERSION = 2
+SHARD_POLL_INTERVAL = 5
+SHARD_CLAIM_TIMEOUT = timedelta(hours=1)
 
 
 @dataclass
@@ -18,163 +44,1053 @@ class VariantDefinition:
     included_ids: set[int]
 
 
+@dataclass
+class ExistingVariant:
+    id: int
+    status: str
+    frozen: bool
+    identity: str
+    card_ids: list[int]
+    template_ids: list[int]
+    of_ids: set[int]
+    included_ids: set[int]
+    produced_ids: set[int]
+
+
 def unique_id_from_cards_and_templates_ids(cards: list[int], templates: list[int]) -> str:
     hash_algorithm = hashlib.sha256()
     hash_algorithm.update(json.dumps({'c': sorted(cards), 't': sorted(templates)}).encode('utf-8'))
     return hash_algorithm.hexdigest()
 
 
-def subtract_removed_features(variant: Variant, features: set[int]) -> set[int]:
-    return features - set(variant.includes.values_list('removes__id', flat=True))
+def variant_definition_to_json(variant_def: VariantDefinition) -> list:
+    return [variant_def.card_ids, variant_def.template_ids, sorted(variant_def.of_ids), sorted(variant_def.feature_ids), sorted(variant_def.included_ids)]
+
+
+def variant_definition_from_json(item: list) -> VariantDefinition:
+    card_ids, template_ids, of_ids, feature_ids, included_ids = item
+    return VariantDefinition(
+        card_ids=card_ids,
+        template_ids=template_ids,
+        of_ids=set(of_ids),
+        feature_ids=set(feature_ids),
+        included_ids=set(included_ids))
+
+
+def subtract_removed_features(included_ids: Iterable[int], features: set[int], removed_features: dict[int, list[int]]) -> set[int]:
+    return features.difference(*(removed_features.get(combo_id, ()) for combo_id in included_ids))
+
 
+def batched(items: list, size: int = BULK_BATCH_SIZE) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-def merge_identities(identities: Iterable[str]):
-    i = set(''.join(identities).upper())
-    return ''.join([color for color in 'WUBRG' if color in i])
 
+def produced_feature_ids(data: Data, variant_def: VariantDefinition, removed_features: dict[int, list[int]]) -> list[int]:
+    return sorted(subtract_removed_features(variant_def.included_ids, variant_def.feature_ids, removed_features) - data.utility_features_ids)
 
-def includes_any(v: set[int], others: Iterable[set[int]]) -> bool:
-    for o in others:
-        if v.issuperset(o):
-            return True
-    return False
 
+def variant_works(data: Data, status: str, card_ids: list[int]) -> bool:
+    # Whether an existing variant is still considered working when it is generated again
+    return status == Variant.Status.OK or \
+        status != Variant.Status.NOT_WORKING and not data.not_working_variants.contains_subset_of(frozenset(card_ids))
 
-def update_variant(
+
+def variant_relations(
         data: Data,
-        unique_id: str,
+        variant_id: int,
         variant_def: VariantDefinition,
-        status: Variant.Status,
-        restore=False):
-    variant = data.variants.get(unique_id=unique_id)
-    variant.of.set(variant_def.of_ids)
-    variant.includes.set(variant_def.included_ids)
-    variant.produces.set(subtract_removed_features(variant, variant_def.feature_ids) - data.utility_features_ids)
-    variant.identity = merge_identities(variant.uses.values_list('identity', flat=True))
-    ok = status == Variant.Status.OK or \
-        status != Variant.Status.NOT_WORKING and not includes_any(v=frozenset(variant_def.card_ids), others=data.not_working_variants)
-    if restore:
-        combos = data.combos.filter(id__in=variant_def.included_ids)
-        variant.zone_locations = '\n'.join(c.zone_locations for c in combos if len(c.zone_locations) > 0)
-        variant.cards_state = '\n'.join(c.cards_state for c in combos if len(c.cards_state) > 0)
-        variant.other_prerequisites = '\n'.join(c.other_prerequisites for c in combos if len(c.other_prerequisites) > 0)
-        variant.mana_needed = ' '.join(c.mana_needed for c in combos if len(c.mana_needed) > 0)
-        variant.description = '\n'.join(c.description for c in combos if len(c.description) > 0)
-        variant.status = Variant.Status.NEW if ok else Variant.Status.NOT_WORKING
-    if not ok:
-        variant.status = Variant.Status.NOT_WORKING
-    if not ok or restore:
-        variant.save()
-    return variant.id
-
-
-def create_variant(
+        removed_features: dict[int, list[int]],
+        with_of: bool = True) -> dict[str, list]:
+    produced_ids = produced_feature_ids(data, variant_def, removed_features)
+    relations = {
+        'includes': [Variant.includes.through(variant_id=variant_id, combo_id=combo_id) for combo_id in sorted(variant_def.included_ids)],
+        # Sorted relations keep the insertion order in their sort_value, starting from 1 like sortedm2m does
+        'produces': [Variant.produces.through(variant_id=variant_id, feature_id=feature_id, sort_value=i) for i, feature_id in enumerate(produced_ids, start=1)],
+    }
+    if with_of:
+        relations['of'] = [Variant.of.through(variant_id=variant_id, combo_id=combo_id) for combo_id in sorted(variant_def.of_ids)]
+    return relations
+
+
+def existing_relations(variant: ExistingVariant) -> dict[str, set[int]]:
+    return {
+        'of': variant.of_ids,
+        'includes': variant.included_ids,
+        'produces': variant.produced_ids,
+    }
+
+
+def related_ids(relation: str, rows: list) -> set[int]:
+    match relation:
+        case 'of' | 'includes':
+            return {row.combo_id for row in rows}
+        case 'produces':
+            return {row.feature_id for row in rows}
+
+
+def delete_relations(variant_ids: dict[str, list[int]]):
+    for relation, relation_variant_ids in variant_ids.items():
+        for ids in batched(relation_variant_ids):
+            getattr(Variant, relation).through.objects.filter(variant_id__in=ids).delete()
+
+
+def bulk_create_relations(relations: dict[str, list]):
+    for relation, rows in relations.items():
+        getattr(Variant, relation).through.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+
+
+def update_variants(
+        data: Data,
+        variants: dict[str, VariantDefinition],
+        existing_variants: dict[str, ExistingVariant],
+        removed_features: dict[int, list[int]],
+        combo_texts: dict[int, ComboText],
+        card_identities: dict[int, str],
+        with_of: bool = True) -> set[int]:
+    # Writes only what differs from the existing variants and returns the ids of the changed ones.
+    # Variants are written in batches, so that only the rows of one batch are in memory at a time.
+    changed_ids = set[int]()
+    for unique_ids in batched(list(variants.keys())):
+        changed_ids.update(update_variants_batch(data, {unique_id: variants[unique_id] for unique_id in unique_ids}, existing_variants, removed_features, combo_texts, card_identities, with_of=with_of))
+    return changed_ids
+
+
+def update_variants_batch(
         data: Data,
-        unique_id: str,
-        variant_def: VariantDefinition):
-    combos = data.combos.filter(id__in=variant_def.included_ids)
-    zone_locations = '\n'.join(c.zone_locations for c in combos if len(c.zone_locations) > 0)
-    cards_state = '\n'.join(c.cards_state for c in combos if len(c.cards_state) > 0)
-    other_prerequisites = '\n'.join(c.other_prerequisites for c in combos if len(c.other_prerequisites) > 0)
-    mana_needed = ' '.join(c.mana_needed for c in combos if len(c.mana_needed) > 0)
-    description = '\n'.join(c.description for c in combos if len(c.description) > 0)
-    ok = not includes_any(v=frozenset(variant_def.card_ids), others=data.not_working_variants)
-    variant = Variant(
-        unique_id=unique_id,
-        zone_locations=zone_locations,
-        cards_state=cards_state,
-        other_prerequisites=other_prerequisites,
-        mana_needed=mana_needed,
-        description=description,
-        identity=merge_identities(data.cards.filter(id__in=variant_def.card_ids).values_list('identity', flat=True)))
-    if not ok:
-        variant.status = Variant.Status.NOT_WORKING
-    variant.save()
-    variant.uses.set(variant_def.card_ids)
-    variant.requires.set(variant_def.template_ids)
-    variant.of.set(variant_def.of_ids)
-    variant.includes.set(variant_def.included_ids)
-    variant.produces.set(subtract_removed_features(variant, variant_def.feature_ids) - data.utility_features_ids)
-    return variant.id
-
-
-def get_variants_from_graph(data: Data, job: Job = None) -> dict[str, VariantDefinition]:
+        variants: dict[str, VariantDefinition],
+        existing_variants: dict[str, ExistingVariant],
+        removed_features: dict[int, list[int]],
+        combo_texts: dict[int, ComboText],
+        card_identities: dict[int, str],
+        with_of: bool = True) -> set[int]:
+    relations = dict[str, list]()
+    stale_relations = dict[str, list[int]]()
+    restored_variants = list[Variant]()
+    not_working_variants = list[Variant]()
+    changed_ids = set[int]()
+    now = timezone.now()
+    for unique_id, variant_def in variants.items():
+        existing_variant = existing_variants[unique_id]
+        old_relations = existing_relations(existing_variant)
+        for relation, rows in variant_relations(data, existing_variant.id, variant_def, removed_features, with_of=with_of).items():
+            if related_ids(relation, rows) != old_relations[relation]:
+                stale_relations.setdefault(relation, []).append(existing_variant.id)
+                relations.setdefault(relation, []).extend(rows)
+                changed_ids.add(existing_variant.id)
+        status = existing_variant.status
+        ok = variant_works(data, status, variant_def.card_ids)
+        restore = status == Variant.Status.RESTORE
+        if not ok or restore:
+            variant = Variant(
+                id=existing_variant.id,
+                identity=merge_identities(card_identities[card_id] for card_id in variant_def.card_ids),
+                status=Variant.Status.NEW if ok else Variant.Status.NOT_WORKING,
+                updated=now)
+            if restore:
+                assemble_variant_text(variant, variant_def.included_ids, combo_texts)
+                restored_variants.append(variant)
+                changed_ids.add(variant.id)
+            elif variant.status != status or variant.identity != existing_variant.identity:
+                not_working_variants.append(variant)
+                changed_ids.add(variant.id)
+    delete_relations(stale_relations)
+    bulk_create_relations(relations)
+    Variant.objects.bulk_update(restored_variants, ['identity', 'status', 'updated', *TEXT_FIELDS], batch_size=BULK_BATCH_SIZE)
+    Variant.objects.bulk_update(not_working_variants, ['identity', 'status', 'updated'], batch_size=BULK_BATCH_SIZE)
+    return changed_ids
+
+
+def update_of_relations(
+        of_ids: dict[str, set[int]],
+        existing_variants: dict[str, ExistingVariant],
+        created_ids: dict[str, int]) -> set[int]:
+    # Writes the combos each variant is an instance of, once all of them are known,
+    # and returns the ids of the changed existing variants
+    changed_ids = set[int]()
+    for unique_ids in batched(list(of_ids.keys())):
+        rows = list[Variant.of.through]()
+        stale_ids = list[int]()
+        for unique_id in unique_ids:
+            if unique_id in created_ids:
+                variant_id = created_ids[unique_id]
+            elif of_ids[unique_id] != existing_variants[unique_id].of_ids:
+                variant_id = existing_variants[unique_id].id
+                stale_ids.append(variant_id)
+            else:
+                continue
+            rows.extend(Variant.of.through(variant_id=variant_id, combo_id=combo_id) for combo_id in sorted(of_ids[unique_id]))
+        delete_relations({'of': stale_ids})
+        bulk_create_relations({'of': rows})
+        changed_ids.update(stale_ids)
+    return changed_ids
+
+
+def create_variants(
+        data: Data,
+        variants: dict[str, VariantDefinition],
+        removed_features: dict[int, list[int]],
+        combo_texts: dict[int, ComboText],
+        card_identities: dict[int, str],
+        with_of: bool = True) -> list[int]:
+    # Variants are written in batches, so that only the rows of one batch are in memory at a time
+    variant_ids = list[int]()
+    for unique_ids in batched(list(variants.keys())):
+        variant_ids.extend(create_variants_batch(data, {unique_id: variants[unique_id] for unique_id in unique_ids}, removed_features, combo_texts, card_identities, with_of=with_of))
+    return variant_ids
+
+
+def create_variants_batch(
+        data: Data,
+        variants: dict[str, VariantDefinition],
+        removed_features: dict[int, list[int]],
+        combo_texts: dict[int, ComboText],
+        card_identities: dict[int, str],
+        with_of: bool = True) -> list[int]:
+    new_variants = list[Variant]()
+    for unique_id, variant_def in variants.items():
+        variant = Variant(
+            unique_id=unique_id,
+            identity=merge_identities(card_identities[card_id] for card_id in variant_def.card_ids))
+        assemble_variant_text(variant, variant_def.included_ids, combo_texts)
+        if data.not_working_variants.contains_subset_of(frozenset(variant_def.card_ids)):
+            variant.status = Variant.Status.NOT_WORKING
+        new_variants.append(variant)
+    Variant.objects.bulk_create(new_variants, batch_size=BULK_BATCH_SIZE)
+    if any(variant.id is None for variant in new_variants):
+        # Some databases cannot return the primary keys of bulk inserted rows
+        ids = dict(Variant.objects.filter(unique_id__in=variants.keys()).values_list('unique_id', 'id'))
+        for variant in new_variants:
+            variant.id = ids[variant.unique_id]
+    relations = dict[str, list](uses=[], requires=[])
+    for variant, variant_def in zip(new_variants, variants.values()):
+        relations['uses'].extend(Variant.uses.through(variant_id=variant.id, card_id=card_id, sort_value=i) for i, card_id in enumerate(variant_def.card_ids, start=1))
+        relations['requires'].extend(Variant.requires.through(variant_id=variant.id, template_id=template_id) for template_id in variant_def.template_ids)
+        for relation, rows in variant_relations(data, variant.id, variant_def, removed_features, with_of=with_of).items():
+            relations.setdefault(relation, []).extend(rows)
+    bulk_create_relations(relations)
+    return [variant.id for variant in new_variants]
+
+
+def combos_variants_serially(graph: Graph, combo_ids: list[int]) -> Iterable[graph_worker.ComboResult]:
+    for combo_id in combo_ids:
+        try:
+            trie = graph.down(combo_id)
+        except BudgetExceeded as e:
+            yield combo_id, [], str(e)
+            continue
+        yield combo_id, [(cards, templates, None) for cards, templates in trie.variants()], None
+
+
+def combos_variants_in_parallel(graph: Graph, combo_ids: list[int], bottom_up: bool = False) -> Iterable[graph_worker.ComboResult]:
+    workers = max(1, settings.PARALLEL_SOLVERS)
+    chunk_size = max(1, math.ceil(len(combo_ids) / (workers * 4)))
+    chunks = [combo_ids[i:i + chunk_size] for i in range(0, len(combo_ids), chunk_size)]
+    # Forked workers must not share the database connections of this process
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=graph_worker.initialize, initargs=(graph,)) as executor:
+        if bottom_up:
+            logging.info(f'Distributing {len(combo_ids)} combos in {len(chunks)} chunks among {workers} workers...')
+            for chunk_result in executor.map(graph_worker.combos_variants, chunks):
+                yield from chunk_result
+            return
+        # The lazy down step depends on the combos visited before, so it runs here in order, like the serial generation,
+        # while the up steps of the variants found by each chunk of combos are distributed among the workers
+        logging.info(f'Distributing the up steps of {len(combo_ids)} combos in {len(chunks)} chunks among {workers} workers...')
+        seen = set[tuple[tuple[int, ...], tuple[int, ...]]]()
+        pending = deque[tuple[list[graph_worker.ComboResult], list[tuple[tuple[int, ...], tuple[int, ...]]], Future]]()
+
+        def merge() -> Iterable[graph_worker.ComboResult]:
+            chunk_result, new_variants, future = pending.popleft()
+            ingredients = dict(zip(new_variants, future.result()))
+            for combo_id, variants, skip_reason in chunk_result:
+                yield combo_id, [(cards, templates, ingredients.get((tuple(cards), tuple(templates)))) for cards, templates, _ in variants], skip_reason
+        for chunk in chunks:
+            chunk_result = list(combos_variants_serially(graph, chunk))
+            new_variants = list[tuple[tuple[int, ...], tuple[int, ...]]]()
+            for _, variants, _ in chunk_result:
+                for cards, templates, _ in variants:
+                    key = (tuple(cards), tuple(templates))
+                    if key not in seen:
+                        seen.add(key)
+                        new_variants.append(key)
+            pending.append((chunk_result, new_variants, executor.submit(graph_worker.closures, [(list(cards), list(templates)) for cards, templates in new_variants])))
+            while len(pending) > workers or (pending and pending[0][2].done()):
+                yield from merge()
+        while pending:
+            yield from merge()
+
+
+class Checkpoint:
+    # Periodically saves the processed combos and the variants found so far,
+    # so that an interrupted generation can be resumed from there.
+    # The mode holds the options that change which variants are found, which a resumed generation must share.
+    def __init__(self, path: Path, fingerprint: str, mode: Optional[dict[str, bool]] = None, interval: float = settings.VARIANTS_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.mode = mode if mode is not None else {}
+        self.interval = interval
+        self.processed_combo_ids = list[int]()
+        self.variants = dict[str, VariantDefinition]()
+        self.last_save = time.monotonic()
+
+    @staticmethod
+    def path_for(job_id: int) -> Path:
+        return Path(settings.VARIANTS_CHECKPOINT_FOLDER) / f'generate_variants_{job_id}.json'
+
+    def resume_from(self, path: Path) -> bool:
+        if not path.exists():
+            logging.warning(f'No checkpoint found at {path}, starting from scratch.')
+            return False
+        with path.open('r', encoding='utf8') as f:
+            content = json.load(f)
+        if content['version'] != CHECKPOINT_VERSION or content['fingerprint'] != self.fingerprint:
+            logging.warning(f'The checkpoint at {path} was made with another catalog or version, starting from scratch.')
+            return False
+        if content['mode'] != self.mode:
+            raise Exception(f'The checkpoint at {path} was made by a generation with {content["mode"]}, which cannot be resumed with {self.mode}')
+        self.processed_combo_ids = content['processed_combo_ids']
+        self.variants = {unique_id: variant_definition_from_json(item) for unique_id, item in content['variants'].items()}
+        return True
+
+    def update(self, combo_id: int, new_variants: dict[str, VariantDefinition], found_again: list[str]):
+        self.processed_combo_ids.append(combo_id)
+        self.variants.update(new_variants)
+        for unique_id in found_again:
+            self.variants[unique_id].of_ids.add(combo_id)
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        content = {
+            'version': CHECKPOINT_VERSION,
+            'fingerprint': self.fingerprint,
+            'mode': self.mode,
+            'processed_combo_ids': self.processed_combo_ids,
+            'variants': {unique_id: variant_definition_to_json(variant_def) for unique_id, variant_def in self.variants.items()},
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Writing to a temporary file first never leaves a truncated checkpoint behind
+        temporary_path = self.path.with_suffix('.tmp')
+        with temporary_path.open('w', encoding='utf8') as f:
+            json.dump(content, f)
+        os.replace(temporary_path, self.path)
+        self.last_save = time.monotonic()
+        logging.info(f'Checkpoint saved after {len(self.processed_combo_ids)} combos.')
+
+    def delete(self):
+        self.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def prune(retention: timedelta = timedelta(days=settings.VARIANTS_CHECKPOINT_RETENTION_DAYS)) -> int:
+        # Deletes the checkpoints of jobs that succeeded or no longer exist, and of failed jobs older than the retention,
+        # keeping the recent failures that can still be resumed
+        folder = Path(settings.VARIANTS_CHECKPOINT_FOLDER)
+        if not folder.is_dir():
+            return 0
+        paths = dict[int, list[Path]]()
+        for path in folder.glob('generate_variants_*.*'):
+            match = re.fullmatch(r'generate_variants_(\d+)\.(?:json|tmp)', path.name)
+            if match is not None:
+                paths.setdefault(int(match.group(1)), []).append(path)
+        jobs = {job_id: (status, termination) for job_id, status, termination in Job.objects.filter(id__in=paths.keys()).values_list('id', 'status', 'termination')}
+        oldest = timezone.now() - retention
+        deleted = 0
+        for job_id, job_paths in paths.items():
+            status, termination = jobs.get(job_id, (None, None))
+            if status == Job.Status.PENDING or status == Job.Status.FAILURE and termination is not None and termination >= oldest:
+                continue
+            for path in job_paths:
+                path.unlink(missing_ok=True)
+                deleted += 1
+        return deleted
+
+
+def find_variants(data: Data, job: Job = None, bottom_up: bool = False, parallel: bool = False, graph: Optional[Graph] = None, combo_ids: Optional[list[int]] = None, checkpoint: Optional[Checkpoint] = None, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None, replayed_combo_ids: Optional[list[int]] = None) -> Iterable[tuple[Optional[int], dict[str, VariantDefinition], list[str]]]:
+    # Yields for every combo the variants found for the first time and the unique ids of those already found.
+    # The variants restored from a checkpoint are yielded first, without a combo.
+    # Combos exceeding the budget are not yielded, but added to skipped with the reason.
+    # In lazy mode the down steps of replayed_combo_ids, the combos visited before the given ones, are replayed first.
     logging.info('Computing all possible variants:')
-    combos = data.combos.filter(generator=True)
-    result = dict[str, VariantDefinition]()
-    graph = Graph(data)
-    total = combos.count()
-    for i, combo in enumerate(combos):
-        variants = graph.variants(combo.id)
-        for variant in variants:
-            cards_ids = [c.id for c in variant.cards]
-            templates_ids = [t.id for t in variant.templates]
+    if profiler is None:
+        profiler = Profiler()
+    if skipped is None:
+        skipped = dict[int, str]()
+    if combo_ids is None:
+        combo_ids = list(data.generator_combo_ids)
+    found = set[str]()
+    replayed_combo_ids = list(replayed_combo_ids or [])
+    if checkpoint is not None and checkpoint.processed_combo_ids:
+        processed_combo_ids = set(checkpoint.processed_combo_ids)
+        last_processed = max((i for i, combo_id in enumerate(combo_ids) if combo_id in processed_combo_ids), default=-1)
+        replayed_combo_ids += combo_ids[:last_processed + 1]
+        combo_ids = [combo_id for combo_id in combo_ids if combo_id not in processed_combo_ids]
+        logging.info(f'Resuming from checkpoint with {len(processed_combo_ids)} combos already processed and {len(checkpoint.variants)} variants found.')
+        found.update(checkpoint.variants.keys())
+        yield None, dict(checkpoint.variants), []
+    if graph is None:
+        with profiler.phase('graph construction'):
+            graph = Graph(data)
+    graph.budget = budget
+    if bottom_up:
+        logging.info('Precomputing all tries bottom-up...')
+        with profiler.phase('bottom-up tries'):
+            graph.precompute_tries(combo_ids)
+    elif replayed_combo_ids:
+        # The lazy tries of a combo depend on the combos visited before it,
+        # so the down steps of the combos before the shard or the checkpoint are replayed in the same order
+        logging.info(f'Replaying the down step of {len(replayed_combo_ids)} previous combos...')
+        with profiler.phase('replay'):
+            for _ in combos_variants_serially(graph, replayed_combo_ids):
+                pass
+    if parallel:
+        combos_variants = combos_variants_in_parallel(graph, combo_ids, bottom_up=bottom_up)
+    else:
+        combos_variants = combos_variants_serially(graph, combo_ids)
+    total = len(combo_ids)
+    progress = JobProgress(job)
+    progress.phase('Computing variants', total=total)
+    closures_reused = 0
+    # In parallel, the time of a combo is only the one spent on it by this process
+    combo_start = time.perf_counter()
+    for i, (combo_id, variants, skip_reason) in enumerate(profiler.iterate('down step', combos_variants)):
+        profiler.count('combos')
+        if skip_reason is not None:
+            # Not checkpointed, so that a resumed generation tries again
+            msg = f'{i + 1}/{total} combos processed (skipped combo {combo_id}: {skip_reason})'
+            logging.warning(msg)
+            skipped[combo_id] = skip_reason
+            profiler.count('combos over budget')
+            progress.advance(message=msg)
+            combo_start = time.perf_counter()
+            continue
+        profiler.count('variants of combos', len(variants))
+        profiler.maximum('most variants of a combo', len(variants))
+        new_variants = dict[str, VariantDefinition]()
+        found_again = list[str]()
+        for cards_ids, templates_ids, ingredients in variants:
             unique_id = unique_id_from_cards_and_templates_ids(cards_ids, templates_ids)
-            feature_ids = set(f.id for f in variant.features)
-            combo_ids = set(c.id for c in variant.combos)
-            if unique_id in result:
-                x = result[unique_id]
-                x.of_ids.add(combo.id)
-                x.included_ids.update(combo_ids)
-                x.feature_ids.update(feature_ids)
+            if unique_id in found:
+                # The up step only depends on the cards and templates,
+                # so the closure computed by a previous combo is still valid
+                closures_reused += 1
+                found_again.append(unique_id)
             else:
-                logging.debug(f'Found new variant for combo {combo.id} ({i + 1}/{total}): {unique_id}')
-                result[unique_id] = VariantDefinition(
-                    card_ids=cards_ids,
-                    template_ids=templates_ids,
-                    feature_ids=feature_ids,
-                    included_ids=combo_ids,
-                    of_ids={combo.id})
-        msg = f'{i + 1}/{total} combos processed (just processed combo {combo.id})'
+                logging.debug(f'Found new variant for combo {combo_id} ({i + 1}/{total}): {unique_id}')
+                found.add(unique_id)
+                if ingredients is not None:
+                    variant = ingredients
+                else:
+                    with profiler.phase('up step'):
+                        variant = graph.up(cards_ids, templates_ids)
+                new_variants[unique_id] = VariantDefinition(
+                    card_ids=variant.cards,
+                    template_ids=variant.templates,
+                    feature_ids=set(variant.features),
+                    included_ids=set(variant.combos),
+                    of_ids={combo_id})
+        profiler.duration('combos', combo_id, time.perf_counter() - combo_start)
+        yield combo_id, new_variants, found_again
+        combo_start = time.perf_counter()
+        if checkpoint is not None:
+            checkpoint.update(combo_id, new_variants, found_again)
+        msg = f'{i + 1}/{total} combos processed (just processed combo {combo_id})'
         logging.info(msg)
-        if job:
-            with transaction.atomic(durable=True):
-                job.message += msg + '\n'
-                job.save()
+        progress.advance(message=msg)
+    progress.save()
+    over_budget = [combo_id for combo_id in combo_ids if combo_id in skipped]
+    if over_budget:
+        logging.warning(f'{len(over_budget)} of {total} combos were skipped for exceeding their budget, their existing variants are kept: {over_budget}')
+    logging.info(f'Up step closures: {closures_reused} reused, {len(found)} computed')
+    profiler.count('distinct variants', len(found))
+    profiler.count('AND pairs', sum(r.pairs for r in graph.statistics.records))
+    profiler.maximum('largest trie', max((r.result_size for r in graph.statistics.records), default=0))
+    logging.info('Trie aggregation statistics:\n' + graph.statistics.summary())
+    logging.info('Trie cache statistics:\n' + graph.cache.summary())
+
+
+def get_variants_from_graph(data: Data, job: Job = None, bottom_up: bool = False, parallel: bool = False, graph: Optional[Graph] = None, combo_ids: Optional[list[int]] = None, checkpoint: Optional[Checkpoint] = None, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None, replayed_combo_ids: Optional[list[int]] = None) -> dict[str, VariantDefinition]:
+    result = dict[str, VariantDefinition]()
+    for combo_id, new_variants, found_again in find_variants(data, job, bottom_up=bottom_up, parallel=parallel, graph=graph, combo_ids=combo_ids, checkpoint=checkpoint, profiler=profiler, budget=budget, skipped=skipped, replayed_combo_ids=replayed_combo_ids):
+        result.update(new_variants)
+        for unique_id in found_again:
+            result[unique_id].of_ids.add(combo_id)
     return result
 
 
-def generate_variants(job: Job = None) -> tuple[int, int, int]:
-    logging.info('Fetching variants set to RESTORE...')
-    data = Data()
-    to_restore = set(data.variants.filter(status=Variant.Status.RESTORE).values_list('unique_id', flat=True))
-    logging.info('Fetching all variant unique ids...')
-    old_id_set = set(data.variants.values_list('unique_id', flat=True))
-    logging.info('Computing combos MILP representation...')
-    variants = get_variants_from_graph(data, job)
+@dataclass
+class ExplainedVariant:
+    unique_id: str
+    ingredients: VariantIngredients
+    up_elapsed: float
+    not_working: bool
+
+
+def explain_combo(combo_id: int, snapshot: Optional[Path] = None) -> tuple[DownTrace, list[ExplainedVariant]]:
+    # Runs the down step of a single combo on a fresh graph, tracing every node it visits, then the up step of its variants
+    data = Data(snapshot)
+    if combo_id not in data.combo_ids:
+        raise Exception(f'Combo {combo_id} does not exist')
+    graph = Graph(data)
+    trace = DownTrace(graph.statistics)
+    graph.trace = trace
+    trie = graph.down(combo_id)
+    graph.trace = None
+    variants = list[ExplainedVariant]()
+    for cards_ids, templates_ids in trie.variants():
+        start = time.perf_counter()
+        ingredients = graph.up(cards_ids, templates_ids)
+        variants.append(ExplainedVariant(
+            unique_id=unique_id_from_cards_and_templates_ids(cards_ids, templates_ids),
+            ingredients=ingredients,
+            up_elapsed=time.perf_counter() - start,
+            not_working=data.not_working_variants.contains_subset_of(frozenset(ingredients.cards))))
+    return trace, variants
+
+
+class VariantWriter(threading.Thread):
+    # Saves batches of variants in its own database transaction while the graph is still being traversed.
+    # The combos each variant is an instance of and the deletions are only written when the traversal is over.
+    def __init__(self, data: Data, existing_variants: dict[str, ExistingVariant], job: Job = None, profiler: Optional[Profiler] = None):
+        super().__init__(name='variant-writer', daemon=True)
+        self.data = data
+        self.existing_variants = existing_variants
+        self.job = job
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.queue = Queue[Optional[dict[str, VariantDefinition]]](maxsize=STREAM_QUEUE_SIZE)
+        self.pending = dict[str, VariantDefinition]()
+        self.of_ids = dict[str, set[int]]()
+        self.to_delete = set[str]()
+        self.aborted = False
+        self.error: Optional[Exception] = None
+        self.created_ids = dict[str, int]()
+        self.changed_ids = set[int]()
+        self.deleted = 0
+
+    def put(self, item: Optional[dict[str, VariantDefinition]]):
+        while self.is_alive():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+        raise Exception('The variant writer stopped unexpectedly') from self.error
+
+    def write(self, variants: dict[str, VariantDefinition]):
+        self.pending.update(variants)
+        if len(self.pending) >= BULK_BATCH_SIZE:
+            self.put(self.pending)
+            self.pending = dict[str, VariantDefinition]()
+
+    def finish(self, of_ids: dict[str, set[int]], to_delete: set[str]):
+        self.put(self.pending)
+        self.of_ids = of_ids
+        self.to_delete = to_delete
+        self.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.aborted = True
+        try:
+            self.put(None)
+        except Exception:
+            # The writer already stopped because of its own error
+            pass
+        self.join()
+
+    def run(self):
+        try:
+            with transaction.atomic():
+                removed_features = group_pairs(self.data.combo_removes)
+                combo_texts = load_combo_texts()
+                card_identities = load_card_identities()
+                while (variants := self.queue.get()) is not None:
+                    with self.profiler.phase('variant writes'):
+                        self.write_batch(variants, removed_features, combo_texts, card_identities)
+                if self.aborted:
+                    raise Exception('Variant generation aborted')
+                with self.profiler.phase('variant writes'):
+                    self.changed_ids.update(update_of_relations(self.of_ids, self.existing_variants, self.created_ids))
+                    if self.job is not None:
+                        self.job.variants.set(self.created_ids.values())
+                with self.profiler.phase('variant deletes'):
+                    self.deleted = delete_variants(self.existing_variants, self.to_delete)
+        except Exception as e:
+            self.error = e
+        finally:
+            connections.close_all()
+
+    def write_batch(self, variants: dict[str, VariantDefinition], removed_features: dict[int, list[int]], combo_texts: dict[int, ComboText], card_identities: dict[int, str]):
+        self.changed_ids.update(update_variants(
+            data=self.data,
+            variants={unique_id: variant_def for unique_id, variant_def in variants.items() if unique_id in self.existing_variants},
+            existing_variants=self.existing_variants,
+            removed_features=removed_features,
+            combo_texts=combo_texts,
+            card_identities=card_identities,
+            with_of=False))
+        new_variants = {unique_id: variant_def for unique_id, variant_def in variants.items() if unique_id not in self.existing_variants}
+        self.created_ids.update(zip(new_variants.keys(), create_variants(
+            data=self.data,
+            variants=new_variants,
+            removed_features=removed_features,
+            combo_texts=combo_texts,
+            card_identities=card_identities,
+            with_of=False)))
+
+
+def stream_variants_from_graph(data: Data, existing_variants: dict[str, ExistingVariant], job: Job = None, bottom_up: bool = False, parallel: bool = False, checkpoint: Optional[Checkpoint] = None, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None) -> VariantWriter:
+    if skipped is None:
+        skipped = dict[int, str]()
+    writer = VariantWriter(data, existing_variants, job, profiler)
+    writer.start()
+    of_ids = dict[str, set[int]]()
+    try:
+        for combo_id, new_variants, found_again in find_variants(data, job, bottom_up=bottom_up, parallel=parallel, checkpoint=checkpoint, profiler=writer.profiler, budget=budget, skipped=skipped):
+            for unique_id, variant_def in new_variants.items():
+                of_ids[unique_id] = set(variant_def.of_ids)
+            for unique_id in found_again:
+                of_ids[unique_id].add(combo_id)
+            if new_variants:
+                writer.write(new_variants)
+    except BaseException:
+        writer.abort()
+        raise
+    kept = keep_variants_of_skipped_combos(of_ids, existing_variants, skipped.keys())
+    writer.finish(of_ids, existing_variants.keys() - of_ids.keys() - kept)
+    return writer
+
+
+def keep_variants_of_skipped_combos(of_ids: dict[str, set[int]], existing_variants: dict[str, ExistingVariant], skipped_combo_ids: Iterable[int]) -> set[str]:
+    # The variants of combos skipped for exceeding their budget stay instances of those combos,
+    # and the ones that were not found again are kept as they are instead of being deleted
+    skipped_combo_ids = set(skipped_combo_ids)
+    kept = set[str]()
+    for unique_id, existing_variant in existing_variants.items():
+        skipped_of_ids = existing_variant.of_ids & skipped_combo_ids
+        if not skipped_of_ids:
+            continue
+        if unique_id in of_ids:
+            of_ids[unique_id].update(skipped_of_ids)
+        else:
+            kept.add(unique_id)
+    return kept
+
+
+def default_budget() -> Budget:
+    return Budget(
+        max_trie_size=settings.VARIANTS_COMBO_MAX_TRIE_SIZE,
+        max_and_pairs=settings.VARIANTS_COMBO_MAX_AND_PAIRS,
+        max_seconds=settings.VARIANTS_COMBO_MAX_SECONDS)
+
+
+def budget_to_json(budget: Budget) -> dict:
+    return dict(max_trie_size=budget.max_trie_size, max_and_pairs=budget.max_and_pairs, max_seconds=budget.max_seconds)
+
+
+def budget_from_json(item: dict) -> Budget:
+    return Budget(max_trie_size=item.get('max_trie_size'), max_and_pairs=item.get('max_and_pairs'), max_seconds=item.get('max_seconds'))
+
+
+def load_existing_variants() -> dict[str, ExistingVariant]:
+    variants = dict[int, ExistingVariant]()
+    unique_ids = dict[int, str]()
+    for variant_id, unique_id, status, frozen, identity in Variant.objects.values_list('id', 'unique_id', 'status', 'frozen', 'identity'):
+        unique_ids[variant_id] = unique_id
+        variants[variant_id] = ExistingVariant(
+            id=variant_id,
+            status=status,
+            frozen=frozen,
+            identity=identity,
+            card_ids=[],
+            template_ids=[],
+            of_ids=set(),
+            included_ids=set(),
+            produced_ids=set())
+    for variant_id, card_id in Variant.uses.through.objects.order_by('sort_value').values_list('variant_id', 'card_id'):
+        variants[variant_id].card_ids.append(card_id)
+    for variant_id, template_id in Variant.requires.through.objects.values_list('variant_id', 'template_id'):
+        variants[variant_id].template_ids.append(template_id)
+    for variant_id, combo_id in Variant.of.through.objects.values_list('variant_id', 'combo_id'):
+        variants[variant_id].of_ids.add(combo_id)
+    for variant_id, combo_id in Variant.includes.through.objects.values_list('variant_id', 'combo_id'):
+        variants[variant_id].included_ids.add(combo_id)
+    for variant_id, feature_id in Variant.produces.through.objects.values_list('variant_id', 'feature_id'):
+        variants[variant_id].produced_ids.add(feature_id)
+    return {unique_ids[variant_id]: variant for variant_id, variant in variants.items()}
+
+
+def last_generation(job: Job = None) -> Optional[Job]:
+    return Job.objects \
+        .filter(name='generate_variants', status=Job.Status.SUCCESS) \
+        .exclude(id=job.id if job is not None else None) \
+        .order_by('-created') \
+        .first()
+
+
+def get_variants_incrementally(data: Data, since: datetime, existing_variants: dict[str, ExistingVariant], job: Job = None, bottom_up: bool = False, parallel: bool = False, checkpoint: Optional[Checkpoint] = None, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None, retried_combo_ids: Iterable[int] = ()) -> tuple[dict[str, VariantDefinition], set[str]]:
+    # Returns the variants that need to be written and the unique ids of the variants to delete.
+    # The retried combos, like the ones skipped by the previous generation, are recomputed even if nothing they depend on changed.
+    if profiler is None:
+        profiler = Profiler()
+    if skipped is None:
+        skipped = dict[int, str]()
+    with profiler.phase('graph construction'):
+        graph = Graph(data)
+    dirty_cards = set(Card.objects.filter(updated__gt=since).values_list('id', flat=True))
+    dirty_templates = set(Template.objects.filter(updated__gt=since).values_list('id', flat=True))
+    dirty_features = set(Feature.objects.filter(updated__gt=since).values_list('id', flat=True))
+    dirty_combos = set(Combo.objects.filter(updated__gt=since).values_list('id', flat=True))
+    logging.info(f'Changed since {since}: {len(dirty_cards)} cards, {len(dirty_templates)} templates, {len(dirty_features)} features, {len(dirty_combos)} combos.')
+    affected_combos = graph.dependent_combos(dirty_cards, dirty_templates, dirty_features, dirty_combos) | set(retried_combo_ids)
+    generator_combos = list(data.generator_combo_ids)
+    combo_ids = [combo_id for combo_id in generator_combos if combo_id in affected_combos]
+    logging.info(f'{len(combo_ids)} generator combos out of {len(generator_combos)} are affected.')
+    variants = get_variants_from_graph(data, job, bottom_up=bottom_up, parallel=parallel, graph=graph, combo_ids=combo_ids, checkpoint=checkpoint, profiler=profiler, budget=budget, skipped=skipped)
+    # Skipped combos keep their variants like unaffected ones
+    unaffected_combos = set(generator_combos) - affected_combos | skipped.keys()
+    to_delete = set[str]()
+    for unique_id, existing_variant in existing_variants.items():
+        # Affected combos have been recomputed, deleted and no longer generator combos are dropped
+        of_ids = existing_variant.of_ids & unaffected_combos
+        if unique_id in variants:
+            variants[unique_id].of_ids.update(of_ids)
+        elif of_ids:
+            # Changed combos can still alter the up step of variants of unaffected combos,
+            # and newly not working variants make their supersets not working too
+            with profiler.phase('up step'):
+                ingredients = graph.up(existing_variant.card_ids, existing_variant.template_ids)
+            if of_ids != existing_variant.of_ids \
+                    or set(ingredients.combos) != existing_variant.included_ids \
+                    or not dirty_cards.isdisjoint(ingredients.cards) \
+                    or not dirty_features.isdisjoint(ingredients.features) \
+                    or not dirty_combos.isdisjoint(ingredients.combos) \
+                    or existing_variant.status == Variant.Status.RESTORE \
+                    or existing_variant.status != Variant.Status.NOT_WORKING and not variant_works(data, existing_variant.status, existing_variant.card_ids):
+                variants[unique_id] = VariantDefinition(
+                    card_ids=ingredients.cards,
+                    template_ids=ingredients.templates,
+                    feature_ids=set(ingredients.features),
+                    included_ids=set(ingredients.combos),
+                    of_ids=of_ids)
+        else:
+            to_delete.add(unique_id)
+    logging.info(f'{len(variants)} variants to write, {len(to_delete)} to delete, {len(existing_variants) - len(to_delete) - len(variants.keys() & existing_variants.keys())} untouched.')
+    return variants, to_delete
+
+
+def diff_variants(
+        data: Data,
+        variants: dict[str, VariantDefinition],
+        existing_variants: dict[str, ExistingVariant],
+        to_delete: set[str],
+        card_identities: dict[int, str]) -> dict:
+    # Describes what saving the variants would write, without writing anything
+    removed_features = group_pairs(data.combo_removes)
+    created = dict[str, dict]()
+    updated = dict[str, dict]()
+    restored = list[str]()
+    for unique_id, variant_def in variants.items():
+        existing_variant = existing_variants.get(unique_id)
+        if existing_variant is None:
+            created[unique_id] = {
+                'uses': variant_def.card_ids,
+                'requires': variant_def.template_ids,
+                'of': sorted(variant_def.of_ids),
+                'includes': sorted(variant_def.included_ids),
+                'produces': produced_feature_ids(data, variant_def, removed_features),
+                'status': Variant.Status.NOT_WORKING if data.not_working_variants.contains_subset_of(frozenset(variant_def.card_ids)) else Variant.Status.NEW,
+            }
+            continue
+        changes = dict[str, dict]()
+        new_relations = {
+            'of': variant_def.of_ids,
+            'includes': variant_def.included_ids,
+            'produces': set(produced_feature_ids(data, variant_def, removed_features)),
+        }
+        for relation, old_ids in existing_relations(existing_variant).items():
+            new_ids = new_relations[relation]
+            if new_ids != old_ids:
+                changes[relation] = {'added': sorted(new_ids - old_ids), 'removed': sorted(old_ids - new_ids)}
+        status = existing_variant.status
+        ok = variant_works(data, status, variant_def.card_ids)
+        if not ok or status == Variant.Status.RESTORE:
+            new_status = Variant.Status.NEW if ok else Variant.Status.NOT_WORKING
+            identity = merge_identities(card_identities[card_id] for card_id in variant_def.card_ids)
+            if new_status != status:
+                changes['status'] = {'old': status, 'new': new_status}
+            if identity != existing_variant.identity:
+                changes['identity'] = {'old': existing_variant.identity, 'new': identity}
+            if status == Variant.Status.RESTORE:
+                restored.append(unique_id)
+        if changes:
+            updated[unique_id] = {'id': existing_variant.id, **changes}
+    deleted = {unique_id: existing_variants[unique_id].id for unique_id in sorted(to_delete) if not existing_variants[unique_id].frozen}
+    return {
+        'summary': {
+            'created': len(created),
+            'updated': len(updated),
+            'restored': len(restored),
+            'deleted': len(deleted),
+            'kept frozen': len(to_delete) - len(deleted),
+            'untouched': len(existing_variants) - len(updated) - len(deleted),
+        },
+        'created': created,
+        'updated': updated,
+        'restored': restored,
+        'deleted': deleted,
+    }
+
+
+def delete_variants(existing_variants: dict[str, ExistingVariant], to_delete: set[str]) -> int:
+    delete_ids = [existing_variants[unique_id].id for unique_id in to_delete if not existing_variants[unique_id].frozen]
+    for ids in batched(delete_ids):
+        Variant.objects.filter(id__in=ids).delete()
+    return len(delete_ids)
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def create_shards(data: Data, job: Job, shards: int, bottom_up: bool = False, budget: Optional[Budget] = None):
+    combo_ids = list(data.generator_combo_ids)
+    size = max(1, math.ceil(len(combo_ids) / max(1, shards)))
+    fingerprint = data.fingerprint()
+    budget_json = budget_to_json(budget if budget is not None else Budget())
+    GenerationShard.objects.bulk_create(
+        GenerationShard(job=job, combo_ids=combo_ids[i:i + size], fingerprint=fingerprint, bottom_up=bottom_up, budget=budget_json)
+        for i in range(0, len(combo_ids), size))
+
+
+def claim_shard(job: Job = None) -> Optional[GenerationShard]:
+    row_locks = connection.features.has_select_for_update_skip_locked
+    while True:
+        # Without row locks, as with SQLite, a transaction would fail to turn from reading into writing
+        # while other workers write: the conditional update alone lets a single worker claim the shard
+        with transaction.atomic() if row_locks else nullcontext():
+            shards = GenerationShard.objects.filter(status=GenerationShard.Status.PENDING)
+            if row_locks:
+                shards = shards.select_for_update(skip_locked=True)
+            if job is not None:
+                shards = shards.filter(job=job)
+            shard = shards.order_by('id').first()
+            if shard is None:
+                return None
+            shard.status = GenerationShard.Status.CLAIMED
+            shard.worker = worker_name()
+            shard.claimed = timezone.now()
+            if GenerationShard.objects.filter(id=shard.id, status=GenerationShard.Status.PENDING).update(status=shard.status, worker=shard.worker, claimed=shard.claimed):
+                return shard
+
+
+def process_shard(data: Data, shard: GenerationShard, parallel: bool = False):
+    logging.info(f'Processing shard {shard.id} of job {shard.job_id} with {len(shard.combo_ids)} combos...')
+    try:
+        if shard.fingerprint != data.fingerprint():
+            raise Exception('The catalog changed since the shard was created')
+        # Bottom-up tries do not depend on which combos are in the shard, while lazy ones depend on the combos
+        # visited before: replaying the down steps of the previous shards makes merging the shards exact in both modes
+        replayed_combo_ids = list[int]()
+        if not shard.bottom_up:
+            combo_ids = list(data.generator_combo_ids)
+            replayed_combo_ids = combo_ids[:combo_ids.index(shard.combo_ids[0])]
+        skipped = dict[int, str]()
+        variants = get_variants_from_graph(data, bottom_up=shard.bottom_up, parallel=parallel, combo_ids=shard.combo_ids, budget=budget_from_json(shard.budget or {}), skipped=skipped, replayed_combo_ids=replayed_combo_ids)
+        result = dict(
+            status=GenerationShard.Status.DONE,
+            variants={unique_id: variant_definition_to_json(variant_def) for unique_id, variant_def in variants.items()},
+            skipped=skipped)
+    except Exception as e:
+        logging.exception(f'Failed to process shard {shard.id}')
+        result = dict(status=GenerationShard.Status.FAILURE, message=str(e))
+    # The shard could have been claimed again by another worker if this one took too long
+    GenerationShard.objects \
+        .filter(id=shard.id, status=GenerationShard.Status.CLAIMED, worker=shard.worker) \
+        .update(finished=timezone.now(), **result)
+
+
+def work_on_shards(job: Job = None, parallel: bool = False, data: Optional[Data] = None) -> int:
+    # Processes pending shards, of any job if none is given, until there are none left
+    processed = 0
+    while (shard := claim_shard(job)) is not None:
+        if data is None or data.fingerprint() != shard.fingerprint:
+            data = Data()
+        process_shard(data, shard, parallel)
+        processed += 1
+    return processed
+
+
+def get_variants_from_shards(data: Data, job: Job, shards: int, bottom_up: bool = False, parallel: bool = False, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None) -> dict[str, VariantDefinition]:
+    if profiler is None:
+        profiler = Profiler()
+    if skipped is None:
+        skipped = dict[int, str]()
+    create_shards(data, job, shards, bottom_up=bottom_up, budget=budget)
+    total = job.shards.count()
+    logging.info(f'Created {total} shards, waiting for workers...')
+    progress = JobProgress(job)
+    progress.phase('Waiting for shards', total=total)
+    try:
+        done = 0
+        while done < total:
+            # The coordinator is a worker too, then waits for the shards claimed by other workers
+            with profiler.phase('shards'):
+                work_on_shards(job, parallel=parallel, data=data)
+            job.shards \
+                .filter(status=GenerationShard.Status.CLAIMED, claimed__lt=timezone.now() - SHARD_CLAIM_TIMEOUT) \
+                .update(status=GenerationShard.Status.PENDING, worker='', claimed=None)
+            failed = job.shards.filter(status=GenerationShard.Status.FAILURE).first()
+            if failed is not None:
+                raise Exception(f'Shard {failed.id} failed on worker {failed.worker}: {failed.message}')
+            previously_done, done = done, job.shards.filter(status=GenerationShard.Status.DONE).count()
+            if done != previously_done:
+                msg = f'{done}/{total} shards done'
+                logging.info(msg)
+                progress.advance(done - previously_done, message=msg)
+            if done < total:
+                with profiler.phase('shards'):
+                    time.sleep(SHARD_POLL_INTERVAL)
+        logging.info('Merging the variants of all shards...')
+        result = dict[str, VariantDefinition]()
+        with profiler.phase('shard merge'):
+            for shard_variants, shard_skipped in job.shards.values_list('variants', 'skipped').iterator():
+                skipped.update((int(combo_id), reason) for combo_id, reason in (shard_skipped or {}).items())
+                for unique_id, item in shard_variants.items():
+                    variant_def = variant_definition_from_json(item)
+                    if unique_id in result:
+                        result[unique_id].of_ids.update(variant_def.of_ids)
+                    else:
+                        result[unique_id] = variant_def
+        return result
+    finally:
+        job.shards.all().delete()
+
+
+def save_variants(data: Data, variants: dict[str, VariantDefinition], existing_variants: dict[str, ExistingVariant], to_delete: set[str], job: Job = None, profiler: Optional[Profiler] = None) -> tuple[int, int, int]:
+    if profiler is None:
+        profiler = Profiler()
+    to_restore = {unique_id for unique_id, variant in existing_variants.items() if variant.status == Variant.Status.RESTORE}
+    old_id_set = set(existing_variants.keys())
     logging.info(f'Saving {len(variants)} variants...')
-    if job:
-        with transaction.atomic(durable=True):
-            job.message += f'Saving {len(variants)} variants...\n'
-            job.save()
-    variants_ids = set()
+    JobProgress(job).phase('Saving variants', message=f'Saving {len(variants)} variants...')
     with transaction.atomic():
-        for unique_id, variant_def in variants.items():
-            if unique_id in old_id_set:
-                status = data.variants.get(unique_id=unique_id).status
-                update_variant(
-                    data=data,
-                    unique_id=unique_id,
-                    variant_def=variant_def,
-                    status=status,
-                    restore=unique_id in to_restore)
-            else:
-                variants_ids.add(
-                    create_variant(
-                        data=data,
-                        unique_id=unique_id,
-                        variant_def=variant_def))
-        if job is not None:
-            job.variants.set(variants_ids)
+        with profiler.phase('variant writes'):
+            removed_features = group_pairs(data.combo_removes)
+            combo_texts = load_combo_texts()
+            card_identities = load_card_identities()
+            changed_ids = update_variants(
+                data=data,
+                variants={unique_id: variant_def for unique_id, variant_def in variants.items() if unique_id in old_id_set},
+                existing_variants=existing_variants,
+                removed_features=removed_features,
+                combo_texts=combo_texts,
+                card_identities=card_identities)
+            variants_ids = create_variants(
+                data=data,
+                variants={unique_id: variant_def for unique_id, variant_def in variants.items() if unique_id not in old_id_set},
+                removed_features=removed_features,
+                combo_texts=combo_texts,
+                card_identities=card_identities)
+            if job is not None:
+                job.variants.set(variants_ids)
         new_id_set = set(variants.keys())
-        to_delete = old_id_set - new_id_set
         added = new_id_set - old_id_set
         restored = new_id_set & to_restore
         logging.info(f'Added {len(added)} new variants.')
         logging.info(f'Updated {len(restored)} variants.')
-        delete_query = data.variants.filter(unique_id__in=to_delete, frozen=False)
-        deleted = delete_query.count()
-        delete_query.delete()
+        with profiler.phase('variant deletes'):
+            deleted = delete_variants(existing_variants, to_delete)
         logging.info(f'Deleted {deleted} variants...')
+        logging.info(f'Created {len(variants_ids)} variants, changed {len(changed_ids)} variants, left {len(existing_variants) - len(changed_ids) - deleted} variants untouched.')
+    profiler.count('variants created', len(variants_ids))
+    profiler.count('variants changed', len(changed_ids))
+    profiler.count('variants deleted', deleted)
+    return len(added), len(restored), deleted
+
+
+def delete_checkpoints(checkpoint: Optional[Checkpoint], resume: Optional[int]):
+    if checkpoint is not None:
+        checkpoint.delete()
+    if resume is not None:
+        Checkpoint.path_for(resume).unlink(missing_ok=True)
+
+
+def generate_variants(job: Job = None, bottom_up: bool = False, parallel: bool = False, incremental: bool = False, snapshot: Optional[Path] = None, stream: bool = False, resume: Optional[int] = None, shards: Optional[int] = None, profiler: Optional[Profiler] = None, budget: Optional[Budget] = None, skipped: Optional[dict[int, str]] = None, diff: Optional[dict] = None) -> tuple[int, int, int]:
+    # The generator combos skipped for exceeding the budget are added to skipped with the reason.
+    # When diff is given nothing is written: it is filled with what saving the variants would change instead.
+    if profiler is None:
+        profiler = Profiler()
+    if budget is None:
+        budget = default_budget()
+    if skipped is None:
+        skipped = dict[int, str]()
+    if incremental and snapshot is not None:
+        # The changes are found from the update times in the database, which a snapshot may not reflect
+        raise Exception('An incremental generation cannot read the catalog from a snapshot')
+    if snapshot is not None:
+        logging.info(f'Loading catalog snapshot from {snapshot}...')
+    with profiler.phase('catalog load'):
+        data = Data(snapshot)
+    checkpoint = None
+    if diff is not None and (stream or shards is not None or resume is not None):
+        raise Exception('A dry run cannot stream, shard or resume a generation')
+    last_job = last_generation(job) if incremental else None
+    if diff is None and (job is not None or resume is not None):
+        checkpoint = Checkpoint(Checkpoint.path_for(job.id if job is not None else resume), data.fingerprint(), mode=dict(bottom_up=bottom_up, incremental=last_job is not None))
+        if resume is not None:
+            checkpoint.resume_from(Checkpoint.path_for(resume))
+    logging.info('Fetching existing variants...')
+    with profiler.phase('existing variants load'):
+        existing_variants = load_existing_variants()
+    to_restore = {unique_id for unique_id, variant in existing_variants.items() if variant.status == Variant.Status.RESTORE}
+    old_id_set = set(existing_variants.keys())
+    if last_job is not None:
+        since = last_job.created
+        retried_combo_ids = [int(combo_id) for combo_id in (last_job.skipped or {})]
+        logging.info(f'Computing variants affected by changes since {since}, retrying {len(retried_combo_ids)} combos skipped by the last generation...')
+        variants, to_delete = get_variants_incrementally(data, since, existing_variants, job, bottom_up=bottom_up, parallel=parallel, checkpoint=checkpoint, profiler=profiler, budget=budget, skipped=skipped, retried_combo_ids=retried_combo_ids)
+    else:
+        if incremental:
+            logging.info('No previous successful generation found, falling back to a full generation.')
+        if stream and job is not None and connection.vendor == 'sqlite':
+            # The job progress is saved while the writer transaction is open, which SQLite cannot do concurrently
+            logging.warning('Streaming needs a database with concurrent writers to report the job progress, saving variants at the end instead.')
+            stream = False
+        if shards is not None:
+            if job is None:
+                raise Exception('Sharded generation needs a job to group its shards')
+            logging.info(f'Computing variants in {shards} shards...')
+            variants = get_variants_from_shards(data, job, shards, bottom_up=bottom_up, parallel=parallel, profiler=profiler, budget=budget, skipped=skipped)
+        elif stream:
+            logging.info('Computing and saving variants while streaming them...')
+            writer = stream_variants_from_graph(data, existing_variants, job, bottom_up=bottom_up, parallel=parallel, checkpoint=checkpoint, profiler=profiler, budget=budget, skipped=skipped)
+            restored = writer.of_ids.keys() & to_restore
+            logging.info(f'Added {len(writer.created_ids)} new variants.')
+            logging.info(f'Updated {len(restored)} variants.')
+            logging.info(f'Deleted {writer.deleted} variants...')
+            logging.info(f'Created {len(writer.created_ids)} variants, changed {len(writer.changed_ids)} variants, left {len(existing_variants) - len(writer.changed_ids) - writer.deleted} variants untouched.')
+            delete_checkpoints(checkpoint, resume)
+            profiler.count('variants created', len(writer.created_ids))
+            profiler.count('variants changed', len(writer.changed_ids))
+            profiler.count('variants deleted', writer.deleted)
+            logging.info('Done.')
+            return len(writer.created_ids), len(restored), writer.deleted
+        else:
+            logging.info('Computing combos MILP representation...')
+            variants = get_variants_from_graph(data, job, bottom_up=bottom_up, parallel=parallel, checkpoint=checkpoint, profiler=profiler, budget=budget, skipped=skipped)
+        kept = keep_variants_of_skipped_combos({unique_id: variant_def.of_ids for unique_id, variant_def in variants.items()}, existing_variants, skipped.keys())
+        to_delete = old_id_set - variants.keys() - kept
+    if diff is not None:
+        with profiler.phase('diff'):
+            diff.update(diff_variants(data, variants, existing_variants, to_delete, load_card_identities()))
+        summary = diff['summary']
+        logging.info(f'Would add {summary["created"]} new variants, update {summary["updated"]} variants, of which {summary["restored"]} restored, and delete {summary["deleted"]} variants.')
         logging.info('Done.')
-        return len(added), len(restored), deleted
+        return summary['created'], summary['restored'], summary['deleted']
+    added, restored, deleted = save_variants(data, variants, existing_variants, to_delete, job, profiler)
+    delete_checkpoints(checkpoint, resume)
+    logging.info('Done.')
+    return added, restored, deleted
@@ -1,6 +1,7 @@
-from .models import Card, Feature, Combo, Template, Variant
-from .serializers import CardDetailSerializer, FeatureSerializer, ComboSerializer, TemplateSerializer, VariantSerializer
+from .models import Card, Feature, Combo, Template, Variant, Job
+from .serializers import CardDetailSerializer, FeatureSerializer, ComboSerializer, TemplateSerializer, VariantSerializer, JobSerializer
 from rest_framework import viewsets
+from rest_framework import permissions
 from rest_framework import filters
 from django_filters.rest_framework import DjangoFilterBackend
 
@@ -53,3 +54,15 @@ class TemplateViewSet(viewsets.ReadOnlyModelViewSet):
 
 template_list = TemplateViewSet.as_view({'get': 'list'})
 template_detail = TemplateViewSet.as_view({'get': 'retrieve'})
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['name', 'status']
+
+
+job_list = JobViewSet.as_view({'get': 'list'})
+job_detail = JobViewSet.as_view({'get': 'retrieve'})